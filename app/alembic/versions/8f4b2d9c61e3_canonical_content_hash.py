@@ -0,0 +1,75 @@
+"""Canonical content hash
+
+Revision ID: 8f4b2d9c61e3
+Revises: 206dc6bed37a
+Create Date: 2026-10-18 09:40:12.532874
+
+"""
+import hashlib
+import json
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = '8f4b2d9c61e3'
+down_revision = '206dc6bed37a'
+branch_labels = None
+depends_on = None
+
+rehash_batch_size = 500
+
+record_state = sa.table(
+    'record_state',
+    sa.column('id', sa.Uuid()),
+    sa.column('data', sa.JSON()),
+    sa.column('hash', sa.String()),
+)
+
+
+def upgrade():
+    # States were hashed with DeepHash before, rehash them with the canonical
+    # JSON hash the no change check compares against
+    connection = op.get_bind()
+
+    update = (
+        record_state.update()
+        .where(record_state.c.id == sa.bindparam('_id'))
+        .values(hash=sa.bindparam('hash'))
+    )
+
+    last_id = None
+
+    while True:
+        statement = sa.select(record_state.c.id, record_state.c.data).order_by(
+            record_state.c.id
+        )
+
+        if last_id is not None:
+            statement = statement.where(record_state.c.id > last_id)
+
+        rows = connection.execute(statement.limit(rehash_batch_size)).all()
+
+        if not rows:
+            break
+
+        connection.execute(
+            update, [{'_id': row.id, 'hash': canonical_hash(row.data)} for row in rows]
+        )
+        last_id = rows[-1].id
+
+
+def canonical_hash(data):
+    # The hash as the app computed it at this revision, kept here so the
+    # migration gives the same results when the app computes it differently
+    canonical = json.dumps(
+        data, sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def downgrade():
+    # The canonical hash is still a valid content hash
+    pass
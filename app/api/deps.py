@@ -1,22 +1,35 @@
-from collections.abc import Generator
+from collections.abc import AsyncGenerator
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, Security, status
+from fastapi import Depends, HTTPException, Request, Response, Security, status
 from fastapi.security import APIKeyHeader
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app import crud_async, ingestion
 from app.core.config import settings
-from app.core.db import engine
+from app.core.db import async_engine, async_transaction_engine
+from app.utils import etag_matches
 
 _api_key_header = APIKeyHeader(name="x-api-key", auto_error=False)
 
 
-def get_db() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    # Nothing may be lazy loaded once the request is handled, keep the state
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
 
 
-DBSessionDep = Annotated[Session, Depends(get_db)]
+DBSessionDep = Annotated[AsyncSession, Depends(get_db)]
+
+
+async def get_transaction_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSession(
+        async_transaction_engine, expire_on_commit=False
+    ) as session:
+        yield session
+
+
+TransactionDBSessionDep = Annotated[AsyncSession, Depends(get_transaction_db)]
 
 
 def check_api_key(x_api_key: str = Security(_api_key_header)):
@@ -28,3 +41,35 @@ def check_api_key(x_api_key: str = Security(_api_key_header)):
 
 
 AuthDep = Depends(check_api_key)
+
+
+async def check_record_etag(
+    logbook_key: str,
+    record_key: str,
+    request: Request,
+    response: Response,
+    db: DBSessionDep,
+):
+    # Read before the states, a write in between only makes the next poll miss
+    etag = await crud_async.get_record_etag(db, logbook_key, record_key)
+
+    if etag is None:
+        return
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        raise HTTPException(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+
+    response.headers["ETag"] = etag
+
+
+RecordETagDep = Depends(check_record_etag)
+
+
+async def wait_for_ingestion():
+    # The states accepted by the ingestion journal have to be stored first
+    await ingestion.wait_until_flushed()
+
+
+IngestionFlushedDep = Depends(wait_for_ingestion)
@@ -0,0 +1,303 @@
+import io
+import time
+import zlib
+
+import zstandard
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.api.responses import ORJSONResponse
+from app.core.metrics import (
+    http_request_duration,
+    http_request_size,
+    http_response_size,
+)
+
+# Preferred first, zstd compresses JSON better and faster than gzip
+COMPRESSION_ENCODINGS = ("zstd", "gzip")
+
+
+class CompressionMiddleware:
+    """Compresses responses with zstd or gzip, whichever the client accepts.
+
+    Like Starlette's GZipMiddleware, which only knows gzip.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1000):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            encoding = negotiate_encoding(
+                Headers(scope=scope).get("accept-encoding", "")
+            )
+
+            if encoding is not None:
+                responder = CompressionResponder(self.app, encoding, self.minimum_size)
+                await responder(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted = set()
+
+    for value in accept_encoding.split(","):
+        encoding, *params = (part.strip() for part in value.split(";"))
+
+        if not any(param.replace(" ", "") in ("q=0", "q=0.0") for param in params):
+            accepted.add(encoding.lower())
+
+    return next(
+        (encoding for encoding in COMPRESSION_ENCODINGS if encoding in accepted),
+        None,
+    )
+
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send | None = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+
+        if encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            # wbits 31 writes a gzip header and trailer
+            self.compressor = zlib.compressobj(wbits=31)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            # Held back until the first body part shows if it's worth compressing
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            # Events have to reach the client when they're sent, not once the
+            # compressor has enough of them
+            self.passthrough = "content-encoding" in headers or headers.get(
+                "content-type", ""
+            ).startswith("text/event-stream")
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.start()
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+
+            if not more_body and len(body) < self.minimum_size:
+                # Answers the ETag the compressed response was sent with
+                if self.initial_message["status"] == 304:
+                    weaken_etag(headers)
+
+                await self.start()
+                await self.send(message)
+                return
+
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            weaken_etag(headers)
+
+        compressed = self.compressor.compress(body)
+
+        if not more_body:
+            compressed += self.compressor.flush()
+
+            if not self.started:
+                headers["Content-Length"] = str(len(compressed))
+
+        await self.start()
+        await self.send(
+            {"type": "http.response.body", "body": compressed, "more_body": more_body}
+        )
+
+    async def start(self):
+        if not self.started:
+            self.started = True
+            await self.send(self.initial_message)
+
+
+def weaken_etag(headers: MutableHeaders):
+    # The compressed bytes differ from the ones a strong ETag was made for
+    if "etag" in headers and not headers["etag"].startswith("W/"):
+        headers["ETag"] = f"W/{headers['etag']}"
+
+
+class RequestDecompressionMiddleware:
+    """Decompresses request bodies sent with a zstd or gzip Content-Encoding, and
+    limits the size of all request bodies, after decompression.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        encoding = headers.get("content-encoding", "identity").strip().lower()
+        content_length = headers.get("content-length")
+
+        if encoding == "identity":
+            if content_length is not None and int(content_length) <= self.max_size:
+                await self.app(scope, receive, send)
+                return
+
+            if content_length is not None:
+                await self.reject(scope, receive, send, 413)
+                return
+        elif encoding not in COMPRESSION_ENCODINGS:
+            await self.reject(scope, receive, send, 415)
+            return
+
+        # Compressed bodies may be smaller than the limit, and chunked ones have no
+        # length, both are read to the end first
+        body = bytearray()
+
+        while True:
+            message = await receive()
+
+            if message["type"] == "http.disconnect":
+                return
+
+            body += message.get("body", b"")
+
+            if len(body) > self.max_size:
+                await self.reject(scope, receive, send, 413)
+                return
+
+            if not message.get("more_body", False):
+                break
+
+        if encoding != "identity":
+            try:
+                body = await run_in_threadpool(
+                    decompress_body, bytes(body), encoding, self.max_size
+                )
+            except (zlib.error, zstandard.ZstdError, EOFError):
+                await self.reject(scope, receive, send, 400)
+                return
+
+            if body is None:
+                await self.reject(scope, receive, send, 413)
+                return
+
+        scope = dict(scope)
+        decompressed_headers = MutableHeaders(scope=scope)
+        del decompressed_headers["content-encoding"]
+        decompressed_headers["content-length"] = str(len(body))
+
+        received = False
+
+        async def receive_body() -> Message:
+            nonlocal received
+
+            if received:
+                return await receive()
+
+            received = True
+
+            return {"type": "http.request", "body": bytes(body), "more_body": False}
+
+        await self.app(scope, receive_body, send)
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send, status: int):
+        detail = {
+            400: "Request body could not be decompressed",
+            413: "Request body too large",
+            415: "Unsupported Content-Encoding",
+        }[status]
+
+        await ORJSONResponse({"detail": detail}, status_code=status)(
+            scope, receive, send
+        )
+
+
+def decompress_body(body: bytes, encoding: str, max_size: int) -> bytes | None:
+    """Decompresses up to max_size bytes, None for more."""
+    if encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(body), read_across_frames=True
+        )
+        decompressed = bytearray()
+
+        while chunk := reader.read(min(max_size + 1 - len(decompressed), 1 << 20)):
+            decompressed += chunk
+
+            if len(decompressed) > max_size:
+                return None
+
+        return bytes(decompressed)
+
+    # wbits 31 expects a gzip header and trailer
+    decompressor = zlib.decompressobj(wbits=31)
+    decompressed = decompressor.decompress(body, max_size + 1)
+
+    if len(decompressed) > max_size:
+        return None
+
+    if not decompressor.eof:
+        raise EOFError("Truncated gzip body")
+
+    return decompressed
+
+
+class MetricsMiddleware:
+    """Times requests and measures their payloads, by route template."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status = 500
+        response_size = 0
+
+        async def send_measured(message: Message):
+            nonlocal status, response_size
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_size += len(message.get("body", b""))
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            # The router sets the matched route, unmatched paths are one label value
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+
+            http_request_duration.labels(method, route_path, status).observe(
+                time.perf_counter() - started_at
+            )
+            http_request_size.labels(method, route_path).observe(
+                int(Headers(scope=scope).get("content-length") or 0)
+            )
+            http_response_size.labels(method, route_path).observe(response_size)
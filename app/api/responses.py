@@ -0,0 +1,11 @@
+from typing import Any
+
+from fastapi import responses
+
+from app.core.metrics import serialization_duration
+
+
+class ORJSONResponse(responses.ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        with serialization_duration.time():
+            return super().render(content)
@@ -1,65 +1,387 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
 from uuid import UUID
 from typing import Literal
 
-from fastapi import APIRouter, HTTPException, Response, status
-
-from app import crud
-from app.api.deps import AuthDep, DBSessionDep
-from app.models import LogbookBase, RecordState, RecordStateBase, RecordStateCreate
-from app.utils import DiffNotation, generate_diff, generate_diff_any, generate_diffs
+import orjson
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud, crud_async, ingestion
+from app.api.responses import ORJSONResponse
+from app.api.deps import (
+    AuthDep,
+    DBSessionDep,
+    IngestionFlushedDep,
+    RecordETagDep,
+    TransactionDBSessionDep,
+)
+from app.core.config import settings
+from app.core.db import async_engine, engine, transaction_engine
+from app.models import (
+    LogbookBase,
+    LogbookRetention,
+    PurgeJob,
+    RecordState,
+    RecordStateBase,
+    RecordStateBulkCreate,
+    RecordStateCreate,
+)
+from app.utils import (
+    DiffNotation,
+    decode_cursor,
+    decode_record_cursor,
+    encode_cursor,
+    encode_record_cursor,
+    generate_diff,
+    generate_diff_any,
+    iter_diff_contents,
+    record_state_content,
+)
 
-from .schemas import DiffDict, PreviewDiff, RecordStateAmount, RecordStateDiff
+from .schemas import (
+    DiffDict,
+    PreviewDiff,
+    RecordQuery,
+    RecordFieldChange,
+    RecordQueryMatch,
+    RecordStateAmount,
+    RecordStateBulkResult,
+    RecordStateDiff,
+)
 
 router = APIRouter(tags=["logbook"])
 
 
 @router.post("/logbook", response_model=LogbookBase, dependencies=[AuthDep])
-def create_logbook(
+async def create_logbook(
     logbook: LogbookBase,
     db: DBSessionDep,
 ):
-    return crud.create_logbook(db, logbook)
+    return await crud_async.create_logbook(db, logbook)
 
 
 @router.get("/logbook", response_model=list[LogbookBase], dependencies=[AuthDep])
-def get_logbooks(
+async def get_logbooks(
     db: DBSessionDep,
 ):
-    return crud.find_all_logbooks(db)
+    return await crud_async.find_all_logbooks(db)
 
 
-@router.delete("/logbook/{logbook_key}", dependencies=[AuthDep])
-def delete_logbook(
+@router.patch(
+    "/logbook/{logbook_key}/retention",
+    response_model=LogbookBase,
+    dependencies=[AuthDep],
+)
+async def update_logbook_retention(
+    logbook_key: str,
+    logbook_retention: LogbookRetention,
+    db: DBSessionDep,
+):
+    return await crud_async.update_logbook_retention(
+        db, logbook_key, logbook_retention
+    )
+
+
+@router.delete(
+    "/logbook/{logbook_key}", dependencies=[AuthDep, IngestionFlushedDep]
+)
+async def delete_logbook(
     logbook_key: str,
     db: DBSessionDep,
+    background_tasks: BackgroundTasks,
+    background: bool = False,
 ):
-    crud.delete_logbook(db, logbook_key)
+    if background:
+        purge_job = await crud_async.create_purge_job(db, logbook_key)
+        background_tasks.add_task(run_purge_job, purge_job.id)
+
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED, content=jsonable_encoder(purge_job)
+        )
+
+    await crud_async.delete_logbook(db, logbook_key)
 
     return Response(status_code=status.HTTP_200_OK)
 
 
+@router.get("/purge/{purge_job_id}", response_model=PurgeJob, dependencies=[AuthDep])
+async def get_purge_job(
+    purge_job_id: UUID,
+    db: DBSessionDep,
+):
+    return await crud_async.get_purge_job(db, purge_job_id)
+
+
+def run_purge_job(purge_job_id: UUID):
+    # Runs in the threadpool after the response is sent, with a session of its own
+    with Session(engine) as db:
+        crud.run_purge_job(db, purge_job_id)
+
+
 @router.get(
     "/logbook/{logbook_key}/record",
     response_model=list[RecordStateAmount],
     dependencies=[AuthDep],
 )
-def get_records(
+async def get_records(
+    logbook_key: str,
+    db: DBSessionDep,
+    response: Response,
+    prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1),
+):
+    try:
+        after = decode_record_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+    # Fetch one record more than requested to know if there is a next page
+    record_heads = await crud_async.find_all_record_keys(
+        db, logbook_key, prefix, after, limit + 1 if limit else None
+    )
+
+    if limit and len(record_heads) > limit:
+        record_heads = record_heads[:limit]
+        response.headers["X-Next-Cursor"] = encode_record_cursor(record_heads[-1].key)
+
+    return record_heads
+
+
+@router.get(
+    "/logbook/{logbook_key}/snapshot",
+    response_model=list[RecordState],
+    dependencies=[AuthDep, IngestionFlushedDep],
+)
+async def get_logbook_snapshot(
     logbook_key: str,
     db: DBSessionDep,
+    response: Response,
+    as_of: datetime | None = None,
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1),
+):
+    try:
+        after = decode_record_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+    # Fetch one record more than requested to know if there is a next page
+    record_states = await crud_async.find_record_states_as_of(
+        db, logbook_key, as_of, after, limit + 1 if limit else None
+    )
+
+    if limit and len(record_states) > limit:
+        record_states = record_states[:limit]
+        response.headers["X-Next-Cursor"] = encode_record_cursor(
+            record_states[-1][0].key
+        )
+
+    return ORJSONResponse(
+        [
+            record_state_content(record_state, raw_data)
+            for record_state, raw_data in record_states
+        ],
+        headers=response.headers,
+    )
+
+
+@router.get(
+    "/logbook/{logbook_key}/changes",
+    response_model=list[RecordStateDiff],
+    responses={200: {"content": {"text/event-stream": {}}}},
+    dependencies=[AuthDep],
+)
+async def get_logbook_changes(
+    logbook_key: str,
+    request: Request,
+    response: Response,
+    notation: DiffNotation = DiffNotation.python,
+    cursor: str | None = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    wait: float = Query(default=0, ge=0, le=settings.CHANGE_FEED_MAX_WAIT),
+    last_event_id: str | None = Header(default=None),
+):
+    # Event streams reconnect with the id of the last event they got
+    cursor = cursor or last_event_id
+
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+    record_states = await poll_logbook_changes(logbook_key, after, limit)
+
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_logbook_changes(logbook_key, notation, after, limit, record_states),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    # Long polling, answers as soon as there are changes or once the wait is over
+    deadline = time.monotonic() + wait
+
+    while not record_states and time.monotonic() < deadline:
+        await asyncio.sleep(
+            min(settings.CHANGE_FEED_POLL_INTERVAL, deadline - time.monotonic())
+        )
+        record_states = await poll_logbook_changes(logbook_key, after, limit)
+
+    if record_states:
+        cursor = encode_cursor(record_states[-1][0])
+
+    # Where to continue from, whether there were changes or not
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+
+    return ORJSONResponse(
+        list(iter_diff_contents(record_states, notation)), headers=response.headers
+    )
+
+
+async def stream_logbook_changes(
+    logbook_key: str,
+    notation: DiffNotation,
+    after: tuple[datetime, UUID] | None,
+    limit: int,
+    record_states: list[tuple[RecordState, str | None]],
 ):
-    return crud.find_all_record_keys(db, logbook_key)
+    # How long to wait before reconnecting, sent first so the response starts
+    yield f"retry: {round(settings.CHANGE_FEED_POLL_INTERVAL * 1000)}\n\n".encode()
+
+    keepalive_at = time.monotonic() + settings.CHANGE_FEED_KEEPALIVE_INTERVAL
+
+    while True:
+        for (record_state, _), content in zip(
+            record_states, iter_diff_contents(record_states, notation)
+        ):
+            yield (
+                f"id: {encode_cursor(record_state)}\ndata: ".encode()
+                + orjson.dumps(content)
+                + b"\n\n"
+            )
+
+        if record_states:
+            after = (record_states[-1][0].created_at, record_states[-1][0].id)
+            keepalive_at = time.monotonic() + settings.CHANGE_FEED_KEEPALIVE_INTERVAL
+        elif time.monotonic() >= keepalive_at:
+            # Also notices a closed connection, which ends the stream
+            yield b": keepalive\n\n"
+            keepalive_at = time.monotonic() + settings.CHANGE_FEED_KEEPALIVE_INTERVAL
+
+        # A full page means there are more changes waiting
+        if len(record_states) < limit:
+            await asyncio.sleep(settings.CHANGE_FEED_POLL_INTERVAL)
+
+        record_states = await poll_logbook_changes(logbook_key, after, limit)
+
+
+async def poll_logbook_changes(
+    logbook_key: str, after: tuple[datetime, UUID] | None, limit: int
+):
+    # Newer states may still be joined by ones committed after them
+    until = datetime.now() - timedelta(seconds=settings.CHANGE_FEED_SETTLE_TIME)
+
+    # The states accepted by the ingestion journal until then have to be stored
+    await ingestion.wait_until_flushed()
+
+    # A session per poll, so waiting consumers don't hold on to a connection
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
+        return await crud_async.find_logbook_changes(
+            db, logbook_key, until, after, limit
+        )
+
+
+@router.post(
+    "/logbook/{logbook_key}/query",
+    response_model=list[RecordQueryMatch],
+    dependencies=[AuthDep],
+)
+async def query_records(
+    logbook_key: str,
+    query: RecordQuery,
+    db: DBSessionDep,
+    response: Response,
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1),
+):
+    try:
+        after = decode_record_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+    # Fetch one record more than requested to know if there is a next page
+    matches = await crud_async.find_matching_records(
+        db, logbook_key, query, after, limit + 1 if limit else None
+    )
+
+    if limit and len(matches) > limit:
+        matches = matches[:limit]
+        response.headers["X-Next-Cursor"] = encode_record_cursor(matches[-1].key)
+
+    return matches
+
+
+@router.post(
+    "/logbook/{logbook_key}/states",
+    response_model=list[RecordStateBulkResult],
+    dependencies=[AuthDep],
+)
+async def create_record_states(
+    logbook_key: str,
+    new_record_states: list[RecordStateBulkCreate],
+    db: TransactionDBSessionDep,
+    prevent_no_changes: bool = False,
+):
+    return await crud_async.create_record_states(
+        db, logbook_key, new_record_states, prevent_no_changes
+    )
 
 
 @router.delete(
     "/logbook/{logbook_key}/record/{record_key}",
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep],
 )
-def delete_record(
+async def delete_record(
     logbook_key: str,
     record_key: str,
-    db: DBSessionDep,
+    db: TransactionDBSessionDep,
+    background_tasks: BackgroundTasks,
+    background: bool = False,
 ):
-    crud.delete_record(db, logbook_key, record_key)
+    if background:
+        purge_job = await crud_async.create_purge_job(db, logbook_key, record_key)
+        background_tasks.add_task(run_purge_job, purge_job.id)
+
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED, content=jsonable_encoder(purge_job)
+        )
+
+    await crud_async.delete_record(db, logbook_key, record_key)
 
     return Response(status_code=status.HTTP_200_OK)
 
@@ -67,93 +389,164 @@ def delete_record(
 @router.post(
     "/logbook/{logbook_key}/record/{record_key}/state",
     response_model=RecordState,
+    responses={
+        202: {"model": RecordState, "description": "Accepted by the ingestion journal"}
+    },
     dependencies=[AuthDep],
 )
-def create_record_state(
+async def create_record_state(
     logbook_key: str,
     record_key: str,
     new_record_state: RecordStateCreate,
-    db: DBSessionDep,
+    db: TransactionDBSessionDep,
     prevent_no_changes: bool = False,
 ):
-    if prevent_no_changes:
-        latest_state = crud.get_latest_record_state(db, logbook_key, record_key)
-
-        if latest_state is not None:
-            diff = generate_diff_any(
-                latest_state.data,
-                new_record_state.data,
-            )
+    if ingestion.journal is not None:
+        record_state = await ingestion.journal.accept(
+            db, logbook_key, record_key, new_record_state, prevent_no_changes
+        )
 
-            if len(diff.affected_paths) == 0:
-                raise HTTPException(
-                    status_code=status.HTTP_406_NOT_ACCEPTABLE,
-                    detail="No changes detected",
-                )
+        return ORJSONResponse(
+            record_state_content(record_state), status_code=status.HTTP_202_ACCEPTED
+        )
 
-    return crud.create_record_state(db, logbook_key, record_key, new_record_state)
+    return await crud_async.create_record_state(
+        db, logbook_key, record_key, new_record_state, prevent_no_changes
+    )
 
 
 @router.get(
     "/logbook/{logbook_key}/record/{record_key}/state",
     response_model=list[RecordStateDiff],
-    dependencies=[AuthDep],
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+    dependencies=[AuthDep, RecordETagDep],
 )
-def get_record_states(
+async def get_record_states(
     logbook_key: str,
     record_key: str,
     db: DBSessionDep,
+    response: Response,
     notation: DiffNotation = DiffNotation.python,
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
 ):
-    return generate_diffs(
-        crud.find_record_states(db, logbook_key, record_key), notation
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+    if stream:
+        # Fail before the response starts, afterwards there's no status code left to set
+        await crud_async.find_record_states_json(
+            db, logbook_key, record_key, after, limit=1
+        )
+
+        return StreamingResponse(
+            stream_record_states(logbook_key, record_key, notation, after, limit),
+            media_type="application/x-ndjson",
+            headers=response.headers,
+        )
+
+    # Fetch one state more than requested to know if there is a next page
+    record_states = await crud_async.find_record_states_json(
+        db, logbook_key, record_key, after, limit + 1 if limit else None
     )
 
+    if limit and len(record_states) > limit:
+        record_states = record_states[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(record_states[-1][0])
+
+    # Already shaped like the response model, validating it again is just slow
+    return ORJSONResponse(
+        list(iter_diff_contents(record_states, notation)), headers=response.headers
+    )
+
+
+def stream_record_states(
+    logbook_key: str,
+    record_key: str,
+    notation: DiffNotation,
+    after: tuple[datetime, UUID] | None,
+    limit: int | None,
+):
+    # The request session is already closed once the response is streamed,
+    # Starlette iterates this sync generator in the threadpool
+    with Session(transaction_engine) as db:
+        record_states = crud.iter_record_states_json(
+            db, logbook_key, record_key, after, limit
+        )
+
+        for content in iter_diff_contents(record_states, notation):
+            yield orjson.dumps(content) + b"\n"
+
+
+@router.get(
+    "/logbook/{logbook_key}/record/{record_key}/field",
+    response_model=list[RecordFieldChange],
+    dependencies=[AuthDep],
+)
+async def get_record_field_changes(
+    logbook_key: str,
+    record_key: str,
+    path: str,
+    db: DBSessionDep,
+):
+    return await crud_async.find_field_changes(db, logbook_key, record_key, path)
+
 
 @router.get(
     "/logbook/{logbook_key}/record/{record_key}/state/{record_state_id}",
     response_model=RecordState,
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep, RecordETagDep],
 )
-def get_record_state(
+async def get_record_state(
     logbook_key: str,
     record_key: str,
     record_state_id: UUID | Literal["latest"],
     db: DBSessionDep,
+    response: Response,
+    as_of: datetime | None = None,
 ):
-    return crud.get_record_state(
-        db, logbook_key, record_key, record_state_id
+    record_state, raw_data = await crud_async.get_record_state_json(
+        db, logbook_key, record_key, record_state_id, as_of
+    )
+
+    return ORJSONResponse(
+        record_state_content(record_state, raw_data), headers=response.headers
     )
 
 
 @router.put(
     "/logbook/{logbook_key}/record/{record_key}/state/{record_state_id}",
     response_model=RecordState,
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep],
 )
-def update_record_state(
+async def update_record_state(
     logbook_key: str,
     record_key: str,
     record_state_id: UUID,
     updated_record_state: RecordStateBase,
-    db: DBSessionDep,
+    db: TransactionDBSessionDep,
 ):
-    return crud.update_record_state(
+    return await crud_async.update_record_state(
         db, logbook_key, record_key, record_state_id, updated_record_state
     )
 
 
 @router.delete(
     "/logbook/{logbook_key}/record/{record_key}/state/{record_state_id}",
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep],
 )
-def delete_record_state(
+async def delete_record_state(
     logbook_key: str,
     record_key: str,
     record_state_id: UUID,
-    db: DBSessionDep,
+    db: TransactionDBSessionDep,
 ):
-    crud.delete_record_state(db, logbook_key, record_key, record_state_id)
+    await crud_async.delete_record_state(db, logbook_key, record_key, record_state_id)
 
     return Response(status_code=status.HTTP_200_OK)
 
@@ -161,19 +554,26 @@ def delete_record_state(
 @router.get(
     "/logbook/{logbook_key}/record/{record_key}/state/{record_state_id}/compare",
     response_model=DiffDict,
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep, RecordETagDep],
 )
-def get_record_state_compare(
+async def get_record_state_compare(
     logbook_key: str,
     record_key: str,
     record_state_id: UUID | Literal["latest"],
     other_record_state_id: UUID | Literal["latest"],
     db: DBSessionDep,
     notation: DiffNotation = DiffNotation.python,
+    as_of: datetime | None = None,
+    other_as_of: datetime | None = None,
 ):
-    diff = generate_diff(
-        crud.get_record_state(db, logbook_key, record_key, record_state_id),
-        crud.get_record_state(db, logbook_key, record_key, other_record_state_id),
+    diff = await run_in_threadpool(
+        generate_diff,
+        await crud_async.get_record_state(
+            db, logbook_key, record_key, record_state_id, as_of
+        ),
+        await crud_async.get_record_state(
+            db, logbook_key, record_key, other_record_state_id, other_as_of
+        ),
         notation,
     )
 
@@ -183,19 +583,21 @@ def get_record_state_compare(
 @router.post(
     "/logbook/{logbook_key}/record/{record_key}/state/preview-diff",
     response_model=DiffDict,
-    dependencies=[AuthDep],
+    dependencies=[AuthDep, IngestionFlushedDep],
 )
-def preview_diff(
+async def preview_diff(
     logbook_key: str,
     record_key: str,
     preview_diff_data: PreviewDiff,
     db: DBSessionDep,
     notation: DiffNotation = DiffNotation.python,
 ):
-    diff = generate_diff_any(
-        crud.get_latest_record_state_or_raise(db, logbook_key, record_key).data,
-        preview_diff_data.data,
-        notation,
+    latest_record_state = await crud_async.get_latest_record_state_or_raise(
+        db, logbook_key, record_key
+    )
+
+    diff = await run_in_threadpool(
+        generate_diff_any, latest_record_state.data, preview_diff_data.data, notation
     )
 
     return diff
@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Response
+
+from app.api.deps import AuthDep
+from app.core.metrics import generate_metrics
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", dependencies=[AuthDep], include_in_schema=False)
+def get_metrics():
+    content, media_type = generate_metrics()
+
+    return Response(content=content, media_type=media_type)
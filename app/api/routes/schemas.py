@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime
+from typing import Any, Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 
 
 class DiffDict(BaseModel):
@@ -15,6 +16,9 @@ class DiffDict(BaseModel):
 class RecordStateAmount(BaseModel):
     key: str
     amount_of_states: int
+    latest_state_id: uuid.UUID
+    first_created_at: datetime
+    last_created_at: datetime
 
 
 class RecordStateDiff(BaseModel):
@@ -40,5 +44,43 @@ class RecordStateDiff(BaseModel):
     #     return json.loads(diff.to_json())
 
 
+class RecordFieldChange(BaseModel):
+    record_state_id: uuid.UUID
+    created_at: datetime
+    # False once the path was removed from the data
+    exists: bool
+    value: Any = None
+
+
+class RecordStateBulkResult(BaseModel):
+    record_key: str
+    id: uuid.UUID | None
+    created: bool
+    detail: str | None = None
+
+
+class RecordQuery(BaseModel):
+    field: Literal["data", "meta"] = "data"
+    # Matches if the field contains this document, like the jsonb @> operator
+    contains: dict | list | None = None
+    # A JSON path predicate, like the jsonb @@ operator
+    path: str | None = None
+    # Match against the latest state of a record only, or any of its states
+    scope: Literal["latest", "any"] = "latest"
+
+    @model_validator(mode="after")
+    def check_predicate(self):
+        if self.contains is None and self.path is None:
+            raise ValueError("Either contains or path is required")
+
+        return self
+
+
+class RecordQueryMatch(BaseModel):
+    key: str
+    record_state_id: uuid.UUID
+    created_at: datetime
+
+
 class PreviewDiff(BaseModel):
     data: dict | list
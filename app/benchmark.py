@@ -0,0 +1,349 @@
+"""Micro-benchmarks of the crud and diff functions.
+
+Fills a logbook of its own with synthetic records and times the crud calls
+behind the API routes, without the HTTP layer. The async routes run the same
+sync crud functions through ``run_sync``, so their cost is what's measured
+here. Results are written as JSON, to compare them between commits.
+"""
+
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import uuid
+from collections import defaultdict
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from enum import Enum
+from typing import Any
+
+import orjson
+from deepdiff import DeepDiff
+from sqlmodel import Session
+
+from app import crud
+from app.core.db import engine, transaction_engine
+from app.models import LogbookBase, RecordStateBulkCreate
+from app.utils import (
+    DiffNotation,
+    deep_diff_to_dict,
+    generate_diff,
+    generate_diff_any,
+    generate_hash,
+    iter_diff_contents,
+)
+
+
+class PayloadShape(str, Enum):
+    flat = "flat"
+    nested = "nested"
+    list = "list"
+
+
+@dataclass
+class BenchmarkOptions:
+    records: int = 100
+    states: int = 20
+    fields: int = 50
+    shape: PayloadShape = PayloadShape.nested
+    change_ratio: float = 0.1
+    keyframe_interval: int | None = None
+    seed: int = 0
+
+
+class Timer:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self.items: dict[str, int] = defaultdict(int)
+
+    def measure(self, operation: str, function: Callable, *args, items: int = 1):
+        started_at = time.perf_counter()
+        result = function(*args)
+        self.samples[operation].append(time.perf_counter() - started_at)
+        self.items[operation] += items
+
+        return result
+
+    def summary(self) -> dict[str, dict]:
+        return {
+            operation: summarize(samples, self.items[operation])
+            for operation, samples in self.samples.items()
+        }
+
+
+def summarize(samples: list[float], items: int):
+    total = sum(samples)
+
+    return {
+        "samples": len(samples),
+        "items": items,
+        "total": total,
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "p95": percentile(samples, 0.95),
+        "max": max(samples),
+        "items_per_second": items / total if total else None,
+    }
+
+
+def percentile(samples: list[float], fraction: float):
+    ordered = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def generate_values(rng: random.Random, fields: int) -> list:
+    return [generate_value(rng) for _ in range(fields)]
+
+
+def generate_value(rng: random.Random):
+    kind = rng.randrange(3)
+
+    if kind == 0:
+        return rng.randrange(1_000_000)
+    if kind == 1:
+        return round(rng.uniform(-1000, 1000), 3)
+
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(4, 24)))
+
+
+def change_values(rng: random.Random, values: list, change_ratio: float) -> list:
+    changed = list(values)
+
+    for index in rng.sample(
+        range(len(values)), max(1, round(len(values) * change_ratio))
+    ):
+        changed[index] = generate_value(rng)
+
+    return changed
+
+
+def build_payload(values: list, shape: PayloadShape) -> dict:
+    if shape == PayloadShape.flat:
+        return {f"field_{index}": value for index, value in enumerate(values)}
+
+    if shape == PayloadShape.list:
+        return {
+            "items": [
+                {"id": index, "value": value} for index, value in enumerate(values)
+            ]
+        }
+
+    # Groups of ten fields, three levels deep
+    payload: dict = {}
+
+    for index, value in enumerate(values):
+        group = payload.setdefault(f"group_{index // 100}", {})
+        subgroup = group.setdefault(f"subgroup_{index // 10 % 10}", {})
+        subgroup[f"field_{index % 10}"] = value
+
+    return payload
+
+
+def run_benchmark(options: BenchmarkOptions) -> dict:
+    rng = random.Random(options.seed)
+    timer = Timer()
+    logbook_key = f"benchmark-{uuid.uuid4().hex[:8]}"
+    record_keys = [f"record-{index}" for index in range(options.records)]
+    values = {key: generate_values(rng, options.fields) for key in record_keys}
+
+    with Session(transaction_engine, expire_on_commit=False) as db:
+        crud.create_logbook(
+            db,
+            LogbookBase(key=logbook_key, keyframe_interval=options.keyframe_interval),
+        )
+
+    try:
+        benchmark_ingestion(timer, rng, options, logbook_key, values)
+        benchmark_reads(timer, rng, options, logbook_key, values)
+        benchmark_functions(timer, rng, options)
+
+        with Session(transaction_engine, expire_on_commit=False) as db:
+            for record_key in record_keys:
+                timer.measure(
+                    "delete_record", crud.delete_record, db, logbook_key, record_key
+                )
+    finally:
+        with Session(engine) as db:
+            crud.delete_logbook(db, logbook_key)
+
+    return {
+        "created_at": datetime.now().isoformat(),
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "database": engine.dialect.name,
+        "options": asdict(options),
+        "operations": timer.summary(),
+    }
+
+
+def benchmark_ingestion(
+    timer: Timer,
+    rng: random.Random,
+    options: BenchmarkOptions,
+    logbook_key: str,
+    values: dict[str, list],
+):
+    # One bulk insert per round, with a state for every record
+    for _ in range(options.states):
+        new_record_states = []
+
+        for record_key, record_values in values.items():
+            values[record_key] = change_values(rng, record_values, options.change_ratio)
+            new_record_states.append(
+                RecordStateBulkCreate(
+                    record_key=record_key,
+                    data=build_payload(values[record_key], options.shape),
+                )
+            )
+
+        with Session(transaction_engine, expire_on_commit=False) as db:
+            timer.measure(
+                "create_record_states",
+                crud.create_record_states,
+                db,
+                logbook_key,
+                new_record_states,
+                items=len(new_record_states),
+            )
+
+
+def benchmark_reads(
+    timer: Timer,
+    rng: random.Random,
+    options: BenchmarkOptions,
+    logbook_key: str,
+    values: dict[str, list],
+):
+    with Session(engine, expire_on_commit=False) as db:
+        for record_key, record_values in values.items():
+            record_states = timer.measure(
+                "find_record_states",
+                find_record_states_content,
+                db,
+                logbook_key,
+                record_key,
+                items=options.states,
+            )
+
+            timer.measure(
+                "compare",
+                compare_record_states,
+                db,
+                logbook_key,
+                record_key,
+                record_states[0][0].id,
+            )
+
+            preview_data = build_payload(
+                change_values(rng, record_values, options.change_ratio),
+                options.shape,
+            )
+            timer.measure(
+                "preview_diff",
+                preview_diff,
+                db,
+                logbook_key,
+                record_key,
+                preview_data,
+            )
+
+
+def find_record_states_content(db: Session, logbook_key: str, record_key: str):
+    # Serialized like the history route does it
+    record_states = crud.find_record_states_json(db, logbook_key, record_key)
+    orjson.dumps(list(iter_diff_contents(record_states)))
+
+    return record_states
+
+
+def compare_record_states(
+    db: Session, logbook_key: str, record_key: str, record_state_id: uuid.UUID
+):
+    return generate_diff(
+        crud.get_record_state(db, logbook_key, record_key, record_state_id),
+        crud.get_record_state(db, logbook_key, record_key, "latest"),
+    )
+
+
+def preview_diff(db: Session, logbook_key: str, record_key: str, data: Any):
+    latest_record_state = crud.get_latest_record_state_or_raise(
+        db, logbook_key, record_key
+    )
+
+    return generate_diff_any(latest_record_state.data, data)
+
+
+def benchmark_functions(timer: Timer, rng: random.Random, options: BenchmarkOptions):
+    # The pure functions, on documents of the same shape and size
+    values = generate_values(rng, options.fields)
+    payload = build_payload(values, options.shape)
+
+    for _ in range(options.records):
+        values = change_values(rng, values, options.change_ratio)
+        other = build_payload(values, options.shape)
+
+        timer.measure("generate_diff_any", generate_diff_any, payload, other)
+        timer.measure(
+            "generate_diff_any_dot", generate_diff_any, payload, other, DiffNotation.dot
+        )
+        timer.measure("deep_diff_to_dict", deep_diff, payload, other)
+        timer.measure("generate_hash", generate_hash, other)
+
+        payload = other
+
+
+def deep_diff(base: Any, other: Any):
+    return deep_diff_to_dict(DeepDiff(base, other))
+
+
+def compare_results(baseline: dict, current: dict, threshold: float):
+    """Compares the median of the operations of two runs.
+
+    An operation regressed if it got slower by more than the threshold, a
+    fraction of the baseline median.
+    """
+    comparisons = []
+
+    for operation, result in current["operations"].items():
+        baseline_result = baseline["operations"].get(operation)
+
+        if baseline_result is None:
+            continue
+
+        ratio = result["median"] / baseline_result["median"]
+
+        comparisons.append(
+            {
+                "operation": operation,
+                "baseline": baseline_result["median"],
+                "current": result["median"],
+                "ratio": ratio,
+                "regressed": ratio > 1 + threshold,
+            }
+        )
+
+    return comparisons
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_results(results: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
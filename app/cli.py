@@ -0,0 +1,219 @@
+import time
+from typing import Annotated
+
+import typer
+from fastapi import HTTPException
+from sqlmodel import Session
+
+from app import benchmark, crud, transfer
+from app.core.db import engine, transaction_engine
+from app.core.migrations import upgrade_database
+
+cli = typer.Typer(no_args_is_help=True)
+
+
+@cli.callback()
+def main():
+    """
+    Trusty Rex management commands.
+    """
+
+
+@cli.command()
+def migrate():
+    """
+    Upgrades the database schema to the latest migration.
+    """
+    if upgrade_database(engine):
+        typer.echo("Migrated the database")
+    else:
+        typer.echo("Database is up to date")
+
+
+@cli.command()
+def compact_logbook(
+    logbook_key: str,
+    keyframe_interval: Annotated[
+        int | None,
+        typer.Option(
+            min=1, help="Store a keyframe every n states, leave out to store all in full"
+        ),
+    ] = None,
+):
+    """
+    Converts the stored states of a logbook to a keyframe interval.
+    """
+    with Session(engine) as db:
+        crud.compact_logbook(db, logbook_key, keyframe_interval)
+
+    typer.echo(f"Compacted logbook {logbook_key}")
+
+
+@cli.command()
+def enforce_retention(
+    interval: Annotated[
+        int | None,
+        typer.Option(min=1, help="Run every n seconds, leave out to run once"),
+    ] = None,
+):
+    """
+    Removes the states the retention policies of the logbooks no longer keep,
+    and the blobs no state refers to anymore.
+    """
+    while True:
+        with Session(transaction_engine, expire_on_commit=False) as db:
+            removed_states = crud.enforce_retention(db)
+            removed_blobs = crud.delete_unused_record_state_blobs(db)
+
+        typer.echo(f"Removed {removed_states} states and {removed_blobs} blobs")
+
+        if interval is None:
+            break
+
+        time.sleep(interval)
+
+
+@cli.command()
+def export_logbook(
+    logbook_key: str,
+    output: Annotated[
+        str | None,
+        typer.Option(help="File to write to, - for stdout, defaults to the key"),
+    ] = None,
+    compression: Annotated[
+        transfer.Compression | None,
+        typer.Option(help="Defaults to the one of the file extension, zstd if none"),
+    ] = None,
+):
+    """
+    Exports a logbook with all its states to a compressed NDJSON file.
+    """
+    output = output or f"{logbook_key}.ndjson.zst"
+
+    with Session(transaction_engine) as db:
+        # Before the file is created
+        if crud.find_logbook(db, logbook_key) is None:
+            typer.echo("Logbook not found", err=True)
+            raise typer.Exit(code=1)
+
+        with transfer.open_export(output, "wb", compression) as file:
+            exported = transfer.export_logbook(
+                db, logbook_key, file, echo_progress("Exported")
+            )
+
+    typer.echo(f"Exported {exported} states to {output}", err=output == "-")
+
+
+@cli.command()
+def import_logbook(
+    input: Annotated[str, typer.Argument(help="File to read from, - for stdin")],
+    logbook_key: Annotated[
+        str | None, typer.Option(help="Import under another key than the exported")
+    ] = None,
+    compression: Annotated[
+        transfer.Compression | None,
+        typer.Option(help="Defaults to the one of the file extension, zstd if none"),
+    ] = None,
+    resume: Annotated[
+        bool, typer.Option(help="Continue an import into the existing logbook")
+    ] = False,
+):
+    """
+    Imports a logbook exported with export-logbook, keeping the ids and times
+    of its states.
+    """
+    try:
+        with (
+            Session(transaction_engine, expire_on_commit=False) as db,
+            transfer.open_export(input, "rb", compression) as file,
+        ):
+            imported = transfer.import_logbook(
+                db, file, logbook_key, resume, echo_progress("Imported")
+            )
+    except (HTTPException, ValueError) as e:
+        typer.echo(getattr(e, "detail", e), err=True)
+        raise typer.Exit(code=1)
+
+    typer.echo(f"Imported {imported} states")
+
+
+def echo_progress(action: str):
+    # To stderr, stdout may be the export itself
+    return lambda states: typer.echo(f"{action} {states} states...", err=True)
+
+
+@cli.command("benchmark")
+def run_benchmark(
+    output: Annotated[str, typer.Option(help="File to write the results to")] = (
+        "benchmark.json"
+    ),
+    records: Annotated[int, typer.Option(min=1)] = 100,
+    states: Annotated[int, typer.Option(min=1, help="States per record")] = 20,
+    fields: Annotated[int, typer.Option(min=1, help="Values per state")] = 50,
+    shape: benchmark.PayloadShape = benchmark.PayloadShape.nested,
+    change_ratio: Annotated[
+        float, typer.Option(min=0, max=1, help="Share of values changed per state")
+    ] = 0.1,
+    keyframe_interval: Annotated[int | None, typer.Option(min=1)] = None,
+    seed: int = 0,
+):
+    """
+    Times the crud and diff functions on a logbook of synthetic records.
+    """
+    results = benchmark.run_benchmark(
+        benchmark.BenchmarkOptions(
+            records=records,
+            states=states,
+            fields=fields,
+            shape=shape,
+            change_ratio=change_ratio,
+            keyframe_interval=keyframe_interval,
+            seed=seed,
+        )
+    )
+    benchmark.write_results(results, output)
+
+    for operation, result in results["operations"].items():
+        typer.echo(
+            f"{operation:<24} median {result['median'] * 1000:9.3f} ms"
+            f"  p95 {result['p95'] * 1000:9.3f} ms"
+        )
+
+    typer.echo(f"Wrote results to {output}")
+
+
+@cli.command()
+def compare_benchmarks(
+    baseline: str,
+    current: str,
+    threshold: Annotated[
+        float, typer.Option(min=0, help="Allowed slowdown of the median, as fraction")
+    ] = 0.1,
+):
+    """
+    Compares two benchmark results, fails if an operation got slower.
+    """
+    baseline_results = benchmark.load_results(baseline)
+    current_results = benchmark.load_results(current)
+
+    if baseline_results["options"] != current_results["options"]:
+        typer.echo("The results were run with different options", err=True)
+
+    comparisons = benchmark.compare_results(
+        baseline_results, current_results, threshold
+    )
+
+    for comparison in comparisons:
+        typer.echo(
+            f"{comparison['operation']:<24} {comparison['baseline'] * 1000:9.3f} ms"
+            f" -> {comparison['current'] * 1000:9.3f} ms"
+            f"  x{comparison['ratio']:.2f}"
+            + ("  REGRESSED" if comparison["regressed"] else "")
+        )
+
+    if any(comparison["regressed"] for comparison in comparisons):
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
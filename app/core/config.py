@@ -34,9 +34,52 @@ class Settings(BaseSettings):
     POSTGRES_DB: str = ""
 
     SQLITE_PATH: str | None = None
+    # WAL lets readers carry on while a write is committed, and with it
+    # synchronous NORMAL only syncs to disk on checkpoints
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_CACHE_SIZE_KIB: int = 16384
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # How long to wait for the write lock, of other workers too, before failing
+    SQLITE_BUSY_TIMEOUT: float = 30
+
+    # Turn off to migrate with `python -m app.cli migrate` before deploying
+    RUN_MIGRATIONS_ON_STARTUP: bool = True
+    DATABASE_CONNECT_TIMEOUT: float = 300
 
     DATABASE_POOL_SIZE: int = 20
     DATABASE_POOL_MAX_OVERFLOW: int = 10
+    DATABASE_STREAM_BATCH_SIZE: int = 500
+    DATABASE_PURGE_BATCH_SIZE: int = 10000
+    # States inserted and committed at a time by logbook imports
+    DATABASE_IMPORT_BATCH_SIZE: int = 5000
+
+    # Largest request body accepted, also after decompressing it
+    REQUEST_MAX_BODY_SIZE: int = 64 * 1024 * 1024
+    # States with more data than this, as JSON, store it compressed in a table of
+    # its own, so scans of the states don't read it. 0 stores all data inline.
+    RECORD_STATE_BLOB_THRESHOLD: int = 128 * 1024
+
+    # Smaller responses aren't worth compressing
+    RESPONSE_COMPRESSION_MINIMUM_SIZE: int = 1000
+
+    # New states are written behind through this journal file, when set
+    INGESTION_JOURNAL_PATH: str | None = None
+    INGESTION_FLUSH_INTERVAL: float = 0.05
+    INGESTION_FLUSH_BATCH_SIZE: int = 1000
+    # How long reads wait for the states accepted before them to be stored
+    INGESTION_READ_TIMEOUT: float = 10
+
+    # States show up in the change feed once they are this old, so writes
+    # committing out of order aren't skipped
+    CHANGE_FEED_SETTLE_TIME: float = 1
+    CHANGE_FEED_POLL_INTERVAL: float = 1
+    CHANGE_FEED_MAX_WAIT: float = 60
+    # Keeps idle event streams from being closed by proxies
+    CHANGE_FEED_KEEPALIVE_INTERVAL: float = 15
+
+    LOGBOOK_CACHE_SIZE: int = 1024
+    LOGBOOK_CACHE_TTL: float = 30
 
     DEFAULT_LOGBOOKS: Annotated[list[str] | str, BeforeValidator(parse_array)] = []
 
@@ -75,6 +118,17 @@ class Settings(BaseSettings):
 
         raise ValueError("No database set")
 
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def SQLALCHEMY_ASYNC_DATABASE_URI(self) -> str | None:
+        database_uri = self.SQLALCHEMY_DATABASE_URI
+
+        # psycopg has an async mode of its own, SQLite needs aiosqlite
+        if self.SQLITE_DATABASE_URI:
+            return f"sqlite+aiosqlite://{self.SQLITE_PATH}"
+
+        return database_uri
+
     @computed_field  # type: ignore[prop-decorator]
     @property
     def SQLALCHEMY_DATABASE_ARGS(self) -> dict:
@@ -88,7 +142,11 @@ class Settings(BaseSettings):
             }
         
         if self.SQLITE_DATABASE_URI:
-            return {}
+            return {
+                "pool_size": self.DATABASE_POOL_SIZE,
+                "max_overflow": self.DATABASE_POOL_MAX_OVERFLOW,
+                "connect_args": {"timeout": self.SQLITE_BUSY_TIMEOUT},
+            }
 
         raise ValueError("No database set")
 
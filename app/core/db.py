@@ -1,9 +1,74 @@
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import Session, create_engine
 
 from app.core.config import settings
+from app.core.metrics import instrument_engine
 
 engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, isolation_level="AUTOCOMMIT", **settings.SQLALCHEMY_DATABASE_ARGS)
 
+# For writes that have to be atomic and for streaming reads, Postgres
+# server-side cursors only live inside a transaction
+transaction_engine = engine.execution_options(
+    isolation_level=(
+        "READ COMMITTED" if engine.dialect.name == "postgresql" else "SERIALIZABLE"
+    )
+)
+
+# aiosqlite would otherwise open a new connection for every session
+async_engine = create_async_engine(settings.SQLALCHEMY_ASYNC_DATABASE_URI, isolation_level="AUTOCOMMIT", poolclass=AsyncAdaptedQueuePool, **settings.SQLALCHEMY_DATABASE_ARGS)
+
+if async_engine.dialect.name == "postgresql":
+    async_transaction_engine = async_engine.execution_options(
+        isolation_level="READ COMMITTED"
+    )
+else:
+    # SQLite takes one writer at a time anyway, so the requests of a worker
+    # queue for a single connection instead of contending for the lock
+    async_transaction_engine = create_async_engine(
+        settings.SQLALCHEMY_ASYNC_DATABASE_URI,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=settings.SQLITE_BUSY_TIMEOUT,
+        connect_args={"timeout": settings.SQLITE_BUSY_TIMEOUT},
+    )
+
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
+if async_transaction_engine.sync_engine is not async_engine.sync_engine:
+    instrument_engine(async_transaction_engine.sync_engine, "writer")
+
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine, "connect")
+    @event.listens_for(async_engine.sync_engine, "connect")
+    @event.listens_for(async_transaction_engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # SQLite only enforces foreign keys, and cascades deletes, when asked to
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        # Negative sizes are in KiB instead of pages
+        cursor.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KIB}")
+        cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        cursor.close()
+
+    @event.listens_for(async_transaction_engine.sync_engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        # The driver would begin deferred transactions, which take the write lock
+        # only on their first write and fail right away if another worker
+        # committed in between
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(async_transaction_engine.sync_engine, "begin")
+    def begin_immediate(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
 
 # make sure all SQLModel models are imported (app.models) before initializing DB
 # otherwise, SQLModel might fail to initialize relationships properly
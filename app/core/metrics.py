@@ -0,0 +1,136 @@
+"""Prometheus metrics of the API, the database and the diffing.
+
+With several workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+before they start, the workers then write their values to files there and
+every worker serves the sum of all of them.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import Engine, event
+from sqlalchemy.pool import QueuePool
+
+PAYLOAD_SIZE_BUCKETS = tuple(4**exponent for exponent in range(4, 14))
+QUERY_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE", "COPY", "WITH")
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request",
+    ["method", "route", "status"],
+)
+http_request_size = Histogram(
+    "http_request_size_bytes",
+    "Size of request bodies",
+    ["method", "route"],
+    buckets=PAYLOAD_SIZE_BUCKETS,
+)
+http_response_size = Histogram(
+    "http_response_size_bytes",
+    "Size of response bodies, after compression",
+    ["method", "route"],
+    buckets=PAYLOAD_SIZE_BUCKETS,
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Time to execute a database query",
+    ["engine", "operation"],
+)
+db_query_errors = Counter(
+    "db_query_errors_total", "Failed database queries", ["engine", "operation"]
+)
+db_pool_size = Gauge(
+    "db_pool_size",
+    "Connections kept open in the pool, more are opened up to the overflow",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+db_pool_checked_out = Gauge(
+    "db_pool_checked_out",
+    "Connections checked out of the pool",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+ingestion_pending_bytes = Gauge(
+    "ingestion_journal_pending_bytes",
+    "Size of the states in the ingestion journal that aren't stored yet",
+    multiprocess_mode="livemax",
+)
+ingestion_lag = Gauge(
+    "ingestion_journal_lag_seconds",
+    "Age of the oldest state in the ingestion journal that isn't stored yet",
+    multiprocess_mode="livemax",
+)
+ingestion_flushed_states = Counter(
+    "ingestion_journal_flushed_states_total",
+    "States moved from the ingestion journal to the database",
+)
+diff_duration = Histogram("diff_duration_seconds", "Time to diff two documents")
+hash_duration = Histogram("hash_duration_seconds", "Time to hash a document")
+serialization_duration = Histogram(
+    "serialization_duration_seconds", "Time to serialize a response body"
+)
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead():
+    # Drops the gauges of this worker, the others keep theirs
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def instrument_engine(engine: Engine, name: str):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started_at = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def observe_query(conn, cursor, statement, parameters, context, executemany):
+        db_query_duration.labels(name, query_operation(statement)).observe(
+            time.perf_counter() - context.metrics_started_at
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def count_query_error(exception_context):
+        db_query_errors.labels(
+            name, query_operation(exception_context.statement or "")
+        ).inc()
+
+    if isinstance(engine.pool, QueuePool):
+        db_pool_size.labels(name).set(engine.pool.size())
+
+    checked_out = db_pool_checked_out.labels(name)
+
+    @event.listens_for(engine, "checkout")
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out.inc()
+
+    @event.listens_for(engine, "checkin")
+    def count_checkin(dbapi_connection, connection_record):
+        checked_out.dec()
+
+
+def query_operation(statement: str):
+    # The first keyword, anything else would make too many label values
+    operation = statement.split(maxsplit=1)[0].upper() if statement.strip() else ""
+
+    return operation if operation in QUERY_OPERATIONS else "OTHER"
@@ -0,0 +1,93 @@
+"""Runs the Alembic migrations in-process.
+
+Workers starting together would all migrate at once, so the upgrade runs
+behind a lock: an advisory lock on Postgres, a file lock next to the database
+on SQLite. Once the schema is at head, checking it takes a single query.
+"""
+
+import fcntl
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import Connection, Engine, text
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+# Any number works, as long as every process migrating the database uses it
+MIGRATION_LOCK_ID = 7_210_400_121
+MIGRATION_LOCK_WAIT_SECONDS = 0.5
+
+
+def alembic_config() -> Config:
+    config = Config(str(ROOT_DIR / "alembic.ini"))
+    config.set_main_option("script_location", str(ROOT_DIR / "app" / "alembic"))
+    # The logging of the app is set up already
+    config.attributes["configure_logger"] = False
+
+    return config
+
+
+def is_at_head(connection: Connection, config: Config) -> bool:
+    heads = set(ScriptDirectory.from_config(config).get_heads())
+
+    return set(MigrationContext.configure(connection).get_current_heads()) == heads
+
+
+@contextmanager
+def migration_lock(engine: Engine):
+    if engine.dialect.name == "postgresql":
+        # Held by the session, the engine autocommits so no transaction stays open.
+        # Waiting in pg_advisory_lock would, and CREATE INDEX CONCURRENTLY waits
+        # for all open transactions to finish.
+        with engine.connect() as connection:
+            while not connection.execute(
+                text("SELECT pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID}
+            ).scalar():
+                time.sleep(MIGRATION_LOCK_WAIT_SECONDS)
+
+            try:
+                yield
+            finally:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID}
+                )
+
+        return
+
+    database = engine.url.database
+
+    if not database or database == ":memory:":
+        yield
+        return
+
+    with open(f"{database}.migrations.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def upgrade_database(engine: Engine) -> bool:
+    """Upgrades the schema to head, returns if there was anything to migrate."""
+    config = alembic_config()
+
+    with engine.connect() as connection:
+        if is_at_head(connection, config):
+            return False
+
+    with migration_lock(engine):
+        # Another process may have migrated while this one waited for the lock
+        with engine.connect() as connection:
+            if is_at_head(connection, config):
+                return False
+
+        command.upgrade(config, "head")
+
+    return True
@@ -1,13 +1,81 @@
-from datetime import datetime
+from collections.abc import Iterable
+from datetime import datetime, timedelta
 from uuid import UUID
-from typing import Literal
+from typing import Any, Literal
 
+import orjson
+import zstandard
 from fastapi import HTTPException, status
-from sqlmodel import Session, func, select
-
-from app.models import LogbookBase, RecordStateCreate
-
-from .models import Logbook, RecordState, RecordStateBase
+from sqlalchemy import (
+    Boolean,
+    Connection,
+    Text,
+    cast,
+    event,
+    exists,
+    inspect,
+    text,
+    type_coerce,
+)
+from sqlalchemy.dialects.postgresql import JSONB, JSONPATH
+from sqlalchemy.exc import DataError, ProgrammingError
+from sqlalchemy.orm import aliased, defer
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
+from sqlmodel import (
+    JSON,
+    Session,
+    case,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    tuple_,
+    update,
+)
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.api.routes.schemas import (
+    RecordFieldChange,
+    RecordQuery,
+    RecordStateBulkResult,
+)
+from app.models import (
+    IngestionEntry,
+    LogbookBase,
+    LogbookRetention,
+    RecordStateBulkCreate,
+    RecordStateCreate,
+)
+
+from .models import (
+    Logbook,
+    PurgeJob,
+    RecordHead,
+    RecordState,
+    RecordStateBase,
+    RecordStateBlob,
+)
+from .utils import (
+    apply_patch,
+    diff_touches_path,
+    generate_diff_to_previous,
+    generate_etag,
+    generate_hash,
+    generate_patch,
+    get_path_value,
+    parse_diff_path,
+    to_local_time,
+)
+
+# The data as stored, for passing it on to responses without parsing it
+raw_data_column = cast(RecordState.data, Text).label("raw_data")
+
+# Logbooks are read on every request but hardly ever change
+logbook_cache: TTLCache[str, Logbook] = TTLCache(
+    settings.LOGBOOK_CACHE_SIZE, settings.LOGBOOK_CACHE_TTL
+)
 
 
 def create_logbook(db: Session, new_logbook: LogbookBase):
@@ -24,6 +92,8 @@ def create_logbook(db: Session, new_logbook: LogbookBase):
     db.commit()
     db.refresh(logbook)
 
+    logbook_cache.pop(logbook.key)
+
     return logbook
 
 
@@ -43,183 +113,1785 @@ def get_logbook(db: Session, key: str):
     return logbook
 
 
+def get_cached_logbook(db: Session, key: str):
+    """Like get_logbook, but returns a detached copy that may be up to
+    LOGBOOK_CACHE_TTL seconds old. Not to be modified."""
+    logbook = logbook_cache.get(key)
+
+    if logbook is None:
+        logbook = Logbook.model_validate(get_logbook(db, key))
+        logbook_cache.set(key, logbook)
+
+    return logbook
+
+
 def delete_logbook(db: Session, key: str):
     logbook = get_logbook(db, key)
 
-    statement = select(RecordState).where(RecordState.logbook_id == logbook.id)
-    states = db.exec(statement).all()
+    # The states go with it, the foreign key cascades
+    db.exec(delete(Logbook).where(Logbook.id == logbook.id))
+    db.commit()
+
+    logbook_cache.pop(key)
+
+
+def update_logbook_retention(
+    db: Session, key: str, logbook_retention: LogbookRetention
+):
+    logbook = get_logbook(db, key)
+
+    logbook.sqlmodel_update(logbook_retention.model_dump(exclude_unset=True))
+    db.add(logbook)
+    db.commit()
+    db.refresh(logbook)
+
+    logbook_cache.pop(key)
+
+    return logbook
+
+
+def compact_logbook(db: Session, key: str, keyframe_interval: int | None):
+    """Rewrites the stored states of a logbook for a new keyframe interval."""
+    logbook = get_logbook(db, key)
+
+    logbook.keyframe_interval = keyframe_interval
+    db.add(logbook)
+    db.commit()
+
+    logbook_cache.pop(key)
+
+    statement = (
+        select(RecordState.key).where(RecordState.logbook_id == logbook.id).distinct()
+    )
+
+    for record_key in db.exec(statement).all():
+        compact_record(db, logbook.id, record_key, keyframe_interval)
+
+
+def compact_record(
+    db: Session, logbook_id: UUID, record_key: str, keyframe_interval: int | None
+):
+    after = None
+    previous_data = None
+    previous_keyframe_distance = 0
+
+    while True:
+        record_states = db.exec(
+            record_states_statement(
+                logbook_id, record_key, after, settings.DATABASE_STREAM_BATCH_SIZE
+            )
+        ).all()
+
+        if not record_states:
+            break
+
+        for record_state in list(load_record_states_data(db, record_states)):
+            data = record_state.data
+
+            store_record_state_data(
+                record_state,
+                data,
+                keyframe_interval,
+                previous_data,
+                previous_keyframe_distance,
+            )
+            flag_modified(record_state, "data")
+            db.add(record_state)
+
+            previous_data = data
+            previous_keyframe_distance = record_state.keyframe_distance
+
+        after = (record_states[-1].created_at, record_states[-1].id)
+        db.commit()
+
+
+def enforce_retention(db: Session, now: datetime | None = None):
+    """Removes the states the retention policies of the logbooks no longer keep.
+
+    Expects a session that doesn't expire on commit, the data of the states is
+    carried over from one batch to the next.
+    """
+    now = now or datetime.now()
+
+    statement = select(Logbook).where(
+        or_(
+            Logbook.retention_max_states.is_not(None),
+            Logbook.retention_max_age_days.is_not(None),
+            Logbook.retention_thin_after_days.is_not(None),
+        )
+    )
+
+    return sum(
+        enforce_logbook_retention(db, logbook, now)
+        for logbook in db.exec(statement).all()
+    )
+
+
+def enforce_logbook_retention(db: Session, logbook: Logbook, now: datetime):
+    removed_states = 0
+    after = None
+
+    while True:
+        statement = (
+            select(RecordHead)
+            .where(RecordHead.logbook_id == logbook.id)
+            .order_by(RecordHead.key)
+            .limit(settings.DATABASE_STREAM_BATCH_SIZE)
+        )
+
+        if after is not None:
+            statement = statement.where(RecordHead.key > after)
+
+        record_heads = db.exec(statement).all()
+
+        if not record_heads:
+            return removed_states
+
+        for record_head in record_heads:
+            removed_states += enforce_record_retention(db, logbook, record_head, now)
+
+        after = record_heads[-1].key
+
+
+def enforce_record_retention(
+    db: Session, logbook: Logbook, record_head: RecordHead, now: datetime
+):
+    drop_count = (
+        max(record_head.amount_of_states - logbook.retention_max_states, 0)
+        if logbook.retention_max_states
+        else 0
+    )
+    age_cutoff = (
+        now - timedelta(days=logbook.retention_max_age_days)
+        if logbook.retention_max_age_days
+        else None
+    )
+    thin_cutoff = (
+        now - timedelta(days=logbook.retention_thin_after_days)
+        if logbook.retention_thin_after_days
+        else None
+    )
+
+    # Nothing old enough to remove, without reading the states
+    if not drop_count and not any(
+        cutoff and record_head.first_created_at < cutoff
+        for cutoff in (age_cutoff, thin_cutoff)
+    ):
+        return 0
+
+    record_states = load_record_states_data(
+        db, iter_record_states_in_batches(db, logbook.id, record_head.key)
+    )
+
+    removed_states = 0
+    removed_ids = []
+    first_retained_record_state = None
+    previous_retained_record_state = None
+
+    # Writes are only flushed on removal, so ingestion isn't blocked in between
+    with db.no_autoflush:
+        for record_state, retained in retention_decisions(
+            record_states, drop_count, age_cutoff, thin_cutoff
+        ):
+            if not retained:
+                removed_ids.append(record_state.id)
+                continue
+
+            if removed_ids:
+                # Its diff and patch refer to a removed state
+                rebase_record_state(record_state, previous_retained_record_state)
+                db.add(record_state)
+
+            first_retained_record_state = first_retained_record_state or record_state
+            previous_retained_record_state = record_state
+
+            # Removed along with the rebase of the state after them, so the stored
+            # chain stays consistent between the batches
+            if len(removed_ids) >= settings.DATABASE_STREAM_BATCH_SIZE:
+                removed_states += remove_record_states(
+                    db, first_retained_record_state, removed_ids
+                )
+                removed_ids = []
+
+        # The latest state is always retained, no removed state is left behind it
+        removed_states += remove_record_states(
+            db, first_retained_record_state, removed_ids
+        )
+
+    return removed_states
+
+
+def iter_record_states_in_batches(db: Session, logbook_id: UUID, record_key: str):
+    after = None
+
+    while True:
+        record_states = db.exec(
+            record_states_statement(
+                logbook_id, record_key, after, settings.DATABASE_STREAM_BATCH_SIZE
+            )
+        ).all()
+
+        if not record_states:
+            return
+
+        yield from record_states
+
+        after = (record_states[-1].created_at, record_states[-1].id)
+
+
+def retention_decisions(
+    record_states: Iterable[RecordState],
+    drop_count: int,
+    age_cutoff: datetime | None,
+    thin_cutoff: datetime | None,
+):
+    """Yields each state with whether it's retained, looking one state ahead to
+    keep the last state of a day when thinning."""
+    previous_record_state = None
+
+    for index, record_state in enumerate(record_states):
+        if previous_record_state is not None:
+            yield previous_record_state, not (
+                index - 1 < drop_count
+                or (age_cutoff and previous_record_state.created_at < age_cutoff)
+                or (
+                    thin_cutoff
+                    and previous_record_state.created_at < thin_cutoff
+                    and previous_record_state.created_at.date()
+                    == record_state.created_at.date()
+                )
+            )
+
+        previous_record_state = record_state
+
+    if previous_record_state is not None:
+        yield previous_record_state, True
 
-    for state in states:
-        db.delete(state)
 
-    db.delete(logbook)
+def remove_record_states(
+    db: Session, first_retained_record_state: RecordState, removed_ids: list[UUID]
+):
+    if removed_ids:
+        db.exec(delete(RecordState).where(RecordState.id.in_(removed_ids)))
+        db.exec(
+            record_head_update_statement(first_retained_record_state).values(
+                amount_of_states=RecordHead.amount_of_states - len(removed_ids),
+                first_created_at=first_retained_record_state.created_at,
+                revision=RecordHead.revision + 1,
+            )
+        )
 
     db.commit()
 
+    return len(removed_ids)
+
 
 def find_all_logbooks(db: Session):
     statement = select(Logbook)
     return db.exec(statement).all()
 
 
-def find_all_record_keys(db: Session, logbook_key: str):
-    logbook = get_logbook(db, logbook_key)
-
+def find_all_record_keys(
+    db: Session,
+    logbook_key: str,
+    prefix: str | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+):
     statement = (
-        select(RecordState.key, func.count(RecordState.id))
-        .where(RecordState.logbook_id == logbook.id)
-        .group_by(RecordState.key)
+        select(RecordHead)
+        .join(Logbook, Logbook.id == RecordHead.logbook_id)
+        .where(Logbook.key == logbook_key)
+        .order_by(RecordHead.key)
     )
-    states = db.exec(statement).all()
 
-    return [{"key": key, "amount_of_states": count} for key, count in states]
+    if prefix:
+        # The lower bound lets the primary key index start at the prefix
+        statement = statement.where(RecordHead.key >= prefix).where(
+            RecordHead.key.startswith(prefix, autoescape=True)
+        )
+
+    if after is not None:
+        statement = statement.where(RecordHead.key > after)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    record_heads = db.exec(statement).all()
+
+    if not record_heads:
+        get_cached_logbook(db, logbook_key)
+
+    return record_heads
+
+
+def find_matching_records(
+    db: Session,
+    logbook_key: str,
+    query: RecordQuery,
+    after: str | None = None,
+    limit: int | None = None,
+):
+    """Finds the records with a latest state, or any state, matching the query.
+
+    Any scope returns the latest matching state of each record.
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Queries are only supported on Postgres",
+        )
+
+    logbook = get_cached_logbook(db, logbook_key)
+
+    if query.field == "data" and logbook.keyframe_interval:
+        # States between keyframes only store a patch
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Data can't be queried in logbooks with a keyframe interval",
+        )
+
+    column = type_coerce(getattr(RecordState, query.field), JSONB)
+    conditions = []
+
+    if query.contains is not None:
+        conditions.append(column.contains(query.contains))
+
+    if query.path is not None:
+        conditions.append(
+            column.op("@@", return_type=Boolean)(cast(query.path, JSONPATH))
+        )
+
+    if query.scope == "latest":
+        statement = (
+            select(
+                RecordHead.key,
+                RecordState.id.label("record_state_id"),
+                RecordState.created_at,
+            )
+            .join(RecordState, RecordState.id == RecordHead.latest_state_id)
+            .where(RecordHead.logbook_id == logbook.id)
+            .order_by(RecordHead.key)
+        )
+        key = RecordHead.key
+    else:
+        statement = (
+            select(
+                RecordState.key,
+                RecordState.id.label("record_state_id"),
+                RecordState.created_at,
+            )
+            .where(RecordState.logbook_id == logbook.id)
+            .distinct(RecordState.key)
+            .order_by(
+                RecordState.key, RecordState.created_at.desc(), RecordState.id.desc()
+            )
+        )
+        key = RecordState.key
+
+    statement = statement.where(*conditions)
+
+    if after is not None:
+        statement = statement.where(key > after)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    try:
+        return db.exec(statement).all()
+    except (DataError, ProgrammingError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON path"
+        )
 
 
 def delete_record(db: Session, logbook_key: str, record_key: str):
-    logbook = get_logbook(db, logbook_key)
+    logbook = get_cached_logbook(db, logbook_key)
 
     statement = (
-        select(RecordState)
+        delete(RecordState)
         .where(RecordState.logbook_id == logbook.id)
         .where(RecordState.key == record_key)
     )
-    states = db.exec(statement).all()
 
-    if not states:
+    if not db.exec(statement).rowcount:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
+        )
+
+    db.exec(delete_record_heads_statement(logbook.id, record_key))
+    db.commit()
+
+
+def create_purge_job(db: Session, logbook_key: str, record_key: str | None = None):
+    logbook = get_logbook(db, logbook_key)
+
+    statement = select(func.count(RecordState.id)).where(
+        RecordState.logbook_id == logbook.id
+    )
+
+    if record_key is not None:
+        statement = statement.where(RecordState.key == record_key)
+
+    total_states = db.exec(statement).one()
+
+    if record_key is not None and not total_states:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
         )
 
-    for state in states:
-        db.delete(state)
+    purge_job = PurgeJob(
+        logbook_id=logbook.id,
+        logbook_key=logbook.key,
+        record_key=record_key,
+        total_states=total_states,
+    )
+
+    db.add(purge_job)
+    # Purged records disappear from the listings right away
+    db.exec(delete_record_heads_statement(logbook.id, record_key))
+    db.commit()
+    db.refresh(purge_job)
+
+    return purge_job
+
+
+def get_purge_job(db: Session, purge_job_id: UUID):
+    purge_job = db.get(PurgeJob, purge_job_id)
+
+    if not purge_job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Purge job not found"
+        )
+
+    return purge_job
+
 
+def run_purge_job(db: Session, purge_job_id: UUID):
+    """Deletes the states of a purge job in chunks, so no statement runs long
+    enough to time out or hold its locks for long."""
+    purge_job = get_purge_job(db, purge_job_id)
+
+    purge_job.status = "running"
+    db.add(purge_job)
     db.commit()
 
+    chunk = (
+        select(RecordState.id)
+        .where(RecordState.logbook_id == purge_job.logbook_id)
+        .limit(settings.DATABASE_PURGE_BATCH_SIZE)
+    )
+
+    if purge_job.record_key is not None:
+        chunk = chunk.where(RecordState.key == purge_job.record_key)
+
+    try:
+        while deleted_states := db.exec(
+            delete(RecordState).where(RecordState.id.in_(chunk))
+        ).rowcount:
+            purge_job.deleted_states += deleted_states
+            db.add(purge_job)
+            db.commit()
+
+        if purge_job.record_key is None:
+            db.exec(delete(Logbook).where(Logbook.id == purge_job.logbook_id))
+            logbook_cache.pop(purge_job.logbook_key)
+
+        purge_job.status = "done"
+    except Exception:
+        db.rollback()
+        purge_job.status = "failed"
+        raise
+    finally:
+        purge_job.finished_at = datetime.now()
+        db.add(purge_job)
+        db.commit()
+
 
 def create_record_state(
     db: Session,
     logbook_key: str,
     record_key: str,
     new_record_state: RecordStateCreate,
+    prevent_no_changes: bool = False,
 ):
-    logbook = get_logbook(db, logbook_key)
+    logbook = get_cached_logbook(db, logbook_key)
+    lock_records(db, logbook.id, [record_key])
 
-    record_state = RecordState.model_validate(
-        new_record_state,
-        update={
-            "logbook_id": logbook.id,
-            "key": record_key,
-            "created_at": datetime.now(),
-        },
+    hash = generate_hash(new_record_state.data)
+
+    # Most pushes are unchanged, so check the hash before loading the previous state
+    if (
+        prevent_no_changes
+        and get_latest_record_state_hash(db, logbook_key, record_key) == hash
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="No changes detected",
+        )
+
+    previous_record_state = get_latest_record_state(db, logbook_key, record_key)
+
+    record_state = build_record_state(
+        logbook, record_key, new_record_state, hash, previous_record_state
     )
 
     db.add(record_state)
+    update_record_heads(db, [record_state_row(record_state)])
     db.commit()
     db.refresh(record_state)
+    set_committed_value(record_state, "data", new_record_state.data)
 
     return record_state
 
 
-def update_record_state(
+def create_record_states(
     db: Session,
     logbook_key: str,
-    record_key: str,
-    record_state_id: UUID,
-    updated_record_state: RecordStateBase,
+    new_record_states: list[RecordStateBulkCreate],
+    prevent_no_changes: bool = False,
 ):
-    record_state = get_record_state(db, logbook_key, record_key, record_state_id)
+    """Creates the states of many records at once, in a single bulk insert."""
+    logbook = get_cached_logbook(db, logbook_key)
+    lock_records(db, logbook.id, [new.record_key for new in new_record_states])
+
+    latest_record_states = find_latest_record_states(
+        db, logbook.id, {new.record_key for new in new_record_states}
+    )
 
-    record_state = record_state.model_validate(updated_record_state)
+    results, rows = build_record_states(
+        logbook, new_record_states, latest_record_states, prevent_no_changes
+    )
 
-    db.refresh(record_state)
+    insert_record_states(db, rows)
+    update_record_heads(db, rows)
     db.commit()
 
-    return record_state
+    return results
 
 
-def delete_record_state(
-    db: Session, logbook_key: str, record_key: str, record_state_id: UUID
-):
-    record_state = get_record_state(db, logbook_key, record_key, record_state_id)
+def lock_records(db: Session, logbook_id: UUID, record_keys: list[str]):
+    """Makes other writes to the records wait until the transaction ends.
 
-    if not record_state:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
-        )
+    A new state is stored relative to the latest one, so two writes reading the
+    same latest state would both diff and patch against it. SQLite has a single
+    writer anyway.
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return
 
-    db.delete(record_state)
-    db.commit()
+    # Taken in the same order by every transaction, so they can't deadlock
+    db.execute(
+        text(
+            "SELECT count(pg_advisory_xact_lock(hashtext(:logbook_id), lock_id)) "
+            "FROM (SELECT DISTINCT hashtext(unnest(CAST(:record_keys AS text[]))) "
+            "AS lock_id ORDER BY lock_id) AS record_locks"
+        ),
+        {"logbook_id": str(logbook_id), "record_keys": record_keys},
+    )
 
 
-def get_record_state(
-    db: Session, logbook_key: str, record_key: str, record_state_id: UUID | Literal["latest"]
+def build_record_states(
+    logbook: Logbook,
+    new_record_states: list[RecordStateBulkCreate],
+    latest_record_states: dict[str, RecordState],
+    prevent_no_changes: bool = False,
 ):
-    logbook = get_logbook(db, logbook_key)
+    results = []
+    rows = []
+
+    for new_record_state in new_record_states:
+        record_key = new_record_state.record_key
+        previous_record_state = latest_record_states.get(record_key)
+        hash = generate_hash(new_record_state.data)
+
+        if (
+            prevent_no_changes
+            and previous_record_state is not None
+            and previous_record_state.hash == hash
+        ):
+            results.append(
+                RecordStateBulkResult(
+                    record_key=record_key,
+                    id=None,
+                    created=False,
+                    detail="No changes detected",
+                )
+            )
+            continue
 
-    if not isinstance(record_state_id, UUID):
-        if record_state_id == "latest":
-            return get_latest_record_state(db, logbook_key, record_key)
-        else:
-            raise HTTPException(
-                status_code=status. HTTP_406_NOT_ACCEPTABLE, detail="Record state not found"
+        record_state = build_record_state(
+            logbook, record_key, new_record_state, hash, previous_record_state
+        )
+
+        # States of the same record in one batch need distinct timestamps
+        if previous_record_state is not None:
+            record_state.created_at = max(
+                record_state.created_at,
+                previous_record_state.created_at + timedelta(microseconds=1),
             )
 
-    statement = (
-        select(RecordState)
-        .where(RecordState.logbook_id == logbook.id)
-        .where(RecordState.key == record_key)
-        .where(RecordState.id == record_state_id)
-    )
+        rows.append(record_state_row(record_state))
 
-    state = db.exec(statement).first()
+        # The next state of the record in this batch is stored relative to the full data
+        record_state.data = new_record_state.data
+        latest_record_states[record_key] = record_state
 
-    if not state:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        results.append(
+            RecordStateBulkResult(record_key=record_key, id=record_state.id, created=True)
         )
 
-    return state
-
+    return results, rows
 
-def get_latest_record_state(db: Session, logbook_key: str, record_key: str):
-    logbook = get_logbook(db, logbook_key)
 
-    statement = (
-        select(RecordState)
-        .where(RecordState.logbook_id == logbook.id)
-        .where(RecordState.key == record_key)
-        .order_by(RecordState.created_at.desc())
+def build_record_state(
+    logbook: Logbook,
+    record_key: str,
+    new_record_state: RecordStateCreate,
+    hash: str,
+    previous_record_state: RecordState | None,
+):
+    record_state = RecordState.model_validate(
+        new_record_state,
+        update={
+            "logbook_id": logbook.id,
+            "key": record_key,
+            "created_at": datetime.now(),
+            "hash": hash,
+            "diff_to_previous": generate_diff_to_previous(
+                previous_record_state, new_record_state
+            ),
+        },
     )
-    state = db.exec(statement).first()
 
-    return state
+    store_record_state_data(
+        record_state,
+        new_record_state.data,
+        logbook.keyframe_interval,
+        previous_record_state.data if previous_record_state else None,
+        previous_record_state.keyframe_distance if previous_record_state else 0,
+    )
 
+    return record_state
 
-def get_latest_record_state_or_raise(db: Session, logbook_key: str, record_key: str):
-    state = get_latest_record_state(db, logbook_key, record_key)
 
-    if not state:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+def build_journaled_record_states(
+    logbook: Logbook,
+    entries: list[IngestionEntry],
+    latest_record_states: dict[str, RecordState],
+    existing_ids: set[UUID],
+):
+    """Like build_record_states, for the states of the ingestion journal, which
+    keep the id and time they were accepted with."""
+    rows = []
+
+    for entry in entries:
+        # Stored already, by a flush that didn't get to record its progress
+        if entry.id in existing_ids:
+            continue
+
+        previous_record_state = latest_record_states.get(entry.record_key)
+
+        if (
+            entry.prevent_no_changes
+            and previous_record_state is not None
+            and previous_record_state.hash == entry.hash
+        ):
+            continue
+
+        record_state = build_record_state(
+            logbook, entry.record_key, entry, entry.hash, previous_record_state
+        )
+        record_state.created_at = (
+            max(
+                entry.created_at,
+                previous_record_state.created_at + timedelta(microseconds=1),
+            )
+            if previous_record_state is not None
+            else entry.created_at
         )
 
-    return state
+        rows.append(record_state_row(record_state))
 
+        record_state.data = entry.data
+        latest_record_states[entry.record_key] = record_state
 
-def find_record_states(db: Session, logbook_key: str, record_key: str):
-    logbook = get_logbook(db, logbook_key)
+    return rows
 
-    record_states = (
-        db.query(RecordState)
-        .filter(RecordState.logbook_id == logbook.id)
-        .filter(RecordState.key == record_key)
-        .order_by(RecordState.key, RecordState.created_at)
-        .all()
-    )
 
-    if not record_states:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
-        )
+def find_existing_record_state_ids(db: Session, ids: list[UUID]):
+    return set(db.exec(select(RecordState.id).where(RecordState.id.in_(ids))).all())
+
+
+def record_state_row(record_state: RecordState):
+    return {
+        column.name: getattr(record_state, column.name)
+        for column in RecordState.__table__.columns
+    }
+
+
+def insert_record_states(db: Session, rows: list[dict]):
+    if not rows:
+        return
+
+    insert_record_state_blobs(db, store_record_state_blobs(rows))
+
+    if db.get_bind().dialect.name != "postgresql":
+        db.execute(insert(RecordState), rows)
+        return
+
+    statement, values = copy_record_states(rows)
+
+    # COPY is the fastest way to get many rows into Postgres
+    cursor = db.connection().connection.cursor()
+
+    with cursor.copy(statement) as copy:
+        for row in values:
+            copy.write_row(row)
+
+
+def copy_record_states(rows: list[dict]):
+    from psycopg.types.json import Json
+
+    columns = list(rows[0])
+    json_columns = {
+        column.name
+        for column in RecordState.__table__.columns
+        if isinstance(column.type, JSON)
+    }
+
+    statement = (
+        f"COPY record_state ({', '.join(f'"{column}"' for column in columns)}) FROM STDIN"
+    )
+    values = (
+        [
+            Json(row[column])
+            if column in json_columns and row[column] is not None
+            else row[column]
+            for column in columns
+        ]
+        for row in rows
+    )
+
+    return statement, values
+
+
+def build_record_state_blob(data: dict | list | None, hash: str | None):
+    """The blob for data larger than RECORD_STATE_BLOB_THRESHOLD as JSON, None for
+    data stored inline."""
+    if data is None or not settings.RECORD_STATE_BLOB_THRESHOLD:
+        return None
+
+    content = orjson.dumps(data)
+
+    if len(content) <= settings.RECORD_STATE_BLOB_THRESHOLD:
+        return None
+
+    return {
+        "hash": hash or generate_hash(data),
+        "size": len(content),
+        "content": zstandard.ZstdCompressor().compress(content),
+    }
+
+
+def store_record_state_blobs(rows: list[dict]):
+    """Moves large data of new states, given as rows, to blobs. Returns the blobs
+    for insert_record_state_blobs."""
+    blobs = {}
+
+    for row in rows:
+        blob = build_record_state_blob(row["data"], row["hash"])
+
+        if blob is not None:
+            row["data"] = None
+            row["blob_hash"] = blob["hash"]
+            blobs[blob["hash"]] = blob
+
+    return list(blobs.values())
+
+
+def insert_record_state_blobs(db: Session, blobs: list[dict]):
+    if blobs:
+        db.execute(
+            insert_record_state_blobs_statement(db.get_bind().dialect.name), blobs
+        )
+
+
+def insert_record_state_blobs_statement(dialect_name: str):
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    # Content addressed, a blob stored already holds the same data
+    return upsert(RecordStateBlob).on_conflict_do_nothing(index_elements=["hash"])
+
+
+@event.listens_for(RecordState, "before_insert")
+@event.listens_for(RecordState, "before_update")
+def store_record_state_blob(mapper, connection: Connection, record_state: RecordState):
+    # States written one at a time, bulk inserts go through store_record_state_blobs.
+    # New states may have their data set without a history.
+    state = inspect(record_state)
+
+    if state.has_identity and not state.attrs.data.history.has_changes():
+        return
+
+    blob = build_record_state_blob(record_state.data, record_state.hash)
+    record_state.blob_hash = blob["hash"] if blob else None
+
+    if blob is not None:
+        connection.execute(
+            insert_record_state_blobs_statement(connection.dialect.name), [blob]
+        )
+        # Set again once written, for whatever uses the state afterwards
+        state.info["blob_data"] = record_state.data
+        record_state.data = None
+
+
+@event.listens_for(RecordState, "after_insert")
+@event.listens_for(RecordState, "after_update")
+def restore_record_state_blob_data(
+    mapper, connection: Connection, record_state: RecordState
+):
+    data = inspect(record_state).info.pop("blob_data", None)
+
+    if data is not None:
+        set_committed_value(record_state, "data", data)
+
+
+def load_record_state_blob(db: Session, blob_hash: str) -> str:
+    """The data stored in a blob, as JSON text."""
+    content = db.exec(
+        select(RecordStateBlob.content).where(RecordStateBlob.hash == blob_hash)
+    ).one()
+
+    return zstandard.ZstdDecompressor().decompress(content).decode()
+
+
+def delete_unused_record_state_blobs(db: Session):
+    """Deletes the blobs of states that were removed, returns how many."""
+    result = db.exec(
+        delete(RecordStateBlob).where(
+            ~exists().where(RecordState.blob_hash == RecordStateBlob.hash)
+        )
+    )
+    db.commit()
+
+    return result.rowcount
+
+
+def update_record_heads(db: Session, rows: list[dict]):
+    """Adds newly inserted states, given as rows, to the heads of their records."""
+    record_heads = {}
+
+    for row in rows:
+        record_head = record_heads.get((row["logbook_id"], row["key"]))
+
+        if record_head is None:
+            record_heads[(row["logbook_id"], row["key"])] = {
+                "logbook_id": row["logbook_id"],
+                "key": row["key"],
+                "latest_state_id": row["id"],
+                "latest_hash": row["hash"],
+                "amount_of_states": 1,
+                "first_created_at": row["created_at"],
+                "last_created_at": row["created_at"],
+            }
+            continue
+
+        record_head["amount_of_states"] += 1
+        record_head["first_created_at"] = min(
+            record_head["first_created_at"], row["created_at"]
+        )
+
+        if row["created_at"] >= record_head["last_created_at"]:
+            record_head["latest_state_id"] = row["id"]
+            record_head["latest_hash"] = row["hash"]
+            record_head["last_created_at"] = row["created_at"]
+
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+
+    record_heads = list(record_heads.values())
+
+    # Chunked, the amount of bound parameters is limited
+    for i in range(0, len(record_heads), settings.DATABASE_STREAM_BATCH_SIZE):
+        statement = upsert(RecordHead).values(
+            record_heads[i : i + settings.DATABASE_STREAM_BATCH_SIZE]
+        )
+        excluded = statement.excluded
+        # Concurrent writers may commit out of order, the latest state is by time
+        is_later = excluded.last_created_at >= RecordHead.last_created_at
+
+        db.exec(
+            statement.on_conflict_do_update(
+                index_elements=[RecordHead.logbook_id, RecordHead.key],
+                set_={
+                    "latest_state_id": case(
+                        (is_later, excluded.latest_state_id),
+                        else_=RecordHead.latest_state_id,
+                    ),
+                    "latest_hash": case(
+                        (is_later, excluded.latest_hash),
+                        else_=RecordHead.latest_hash,
+                    ),
+                    "last_created_at": case(
+                        (is_later, excluded.last_created_at),
+                        else_=RecordHead.last_created_at,
+                    ),
+                    "first_created_at": case(
+                        (
+                            excluded.first_created_at < RecordHead.first_created_at,
+                            excluded.first_created_at,
+                        ),
+                        else_=RecordHead.first_created_at,
+                    ),
+                    "amount_of_states": RecordHead.amount_of_states
+                    + excluded.amount_of_states,
+                    "revision": RecordHead.revision + 1,
+                },
+            )
+        )
+
+
+def remove_from_record_head(
+    db: Session,
+    record_state: RecordState,
+    previous_record_state: RecordState | None,
+    next_record_state: RecordState | None,
+):
+    if previous_record_state is None and next_record_state is None:
+        db.exec(delete_record_heads_statement(record_state.logbook_id, record_state.key))
+        return
+
+    values = {
+        "amount_of_states": RecordHead.amount_of_states - 1,
+        "revision": RecordHead.revision + 1,
+    }
+
+    if next_record_state is None:
+        values["latest_state_id"] = previous_record_state.id
+        values["latest_hash"] = previous_record_state.hash
+        values["last_created_at"] = previous_record_state.created_at
+
+    if previous_record_state is None:
+        values["first_created_at"] = next_record_state.created_at
+
+    db.exec(record_head_update_statement(record_state).values(values))
+
+
+def record_head_update_statement(record_state: RecordState):
+    return (
+        update(RecordHead)
+        .where(RecordHead.logbook_id == record_state.logbook_id)
+        .where(RecordHead.key == record_state.key)
+    )
+
+
+def updated_record_head_statement(
+    record_state: RecordState, next_record_state: RecordState | None
+):
+    values = {"revision": RecordHead.revision + 1}
+
+    if next_record_state is None:
+        values["latest_hash"] = record_state.hash
+
+    return record_head_update_statement(record_state).values(values)
+
+
+def delete_record_heads_statement(logbook_id: UUID, record_key: str | None = None):
+    statement = delete(RecordHead).where(RecordHead.logbook_id == logbook_id)
+
+    if record_key is not None:
+        statement = statement.where(RecordHead.key == record_key)
+
+    return statement
+
+
+def update_record_state(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID,
+    updated_record_state: RecordStateBase,
+):
+    lock_records(db, get_cached_logbook(db, logbook_key).id, [record_key])
+    record_state = get_record_state(db, logbook_key, record_key, record_state_id)
+
+    # Load the neighbours before the update is flushed, their data may depend on it
+    previous_record_state = find_previous_record_state(db, record_state)
+    next_record_state = find_next_record_state(db, record_state)
+
+    apply_record_state_update(
+        record_state, updated_record_state, previous_record_state, next_record_state
+    )
+    db.add(record_state)
+
+    if next_record_state:
+        db.add(next_record_state)
+
+    db.exec(updated_record_head_statement(record_state, next_record_state))
+
+    db.commit()
+    db.refresh(record_state)
+
+    return load_record_state_data(db, record_state)
+
+
+def apply_record_state_update(
+    record_state: RecordState,
+    updated_record_state: RecordStateBase,
+    previous_record_state: RecordState | None,
+    next_record_state: RecordState | None,
+):
+    record_state.sqlmodel_update(updated_record_state.model_dump())
+    record_state.hash = generate_hash(record_state.data)
+    record_state.diff_to_previous = generate_diff_to_previous(
+        previous_record_state, record_state
+    )
+    # Patches can't be rebased, so the changed state and the next one become keyframes
+    record_state.patch = None
+    record_state.keyframe_distance = 0
+
+    if next_record_state:
+        rebase_record_state(next_record_state, record_state)
+
+
+def delete_record_state(
+    db: Session, logbook_key: str, record_key: str, record_state_id: UUID
+):
+    record_state = get_record_state(db, logbook_key, record_key, record_state_id)
+
+    if not record_state:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    previous_record_state = find_previous_record_state(db, record_state)
+    next_record_state = find_next_record_state(db, record_state)
+
+    if next_record_state:
+        # The next state now follows the one before the deleted state
+        rebase_record_state(next_record_state, previous_record_state)
+        db.add(next_record_state)
+
+    remove_from_record_head(db, record_state, previous_record_state, next_record_state)
+    db.delete(record_state)
+    db.commit()
+
+
+def get_record_state(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID | Literal["latest"],
+    as_of: datetime | None = None,
+):
+    check_as_of(record_state_id, as_of)
+
+    if not isinstance(record_state_id, UUID):
+        if record_state_id == "latest" and as_of is not None:
+            return get_record_state_as_of(db, logbook_key, record_key, as_of)
+
+        if record_state_id == "latest":
+            return get_latest_record_state(db, logbook_key, record_key)
+        else:
+            raise HTTPException(
+                status_code=status. HTTP_406_NOT_ACCEPTABLE, detail="Record state not found"
+            )
+
+    statement = (
+        filter_by_logbook(select(RecordState), logbook_key)
+        .where(RecordState.key == record_key)
+        .where(RecordState.id == record_state_id)
+    )
+
+    state = db.exec(statement).first()
+
+    if not state:
+        get_cached_logbook(db, logbook_key)
+
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    return load_record_state_data(db, state)
+
+
+def get_record_state_json(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID | Literal["latest"],
+    as_of: datetime | None = None,
+):
+    """Like get_record_state, but returns the data of keyframes as JSON text too,
+    which is passed on to the response without parsing it."""
+    check_as_of(record_state_id, as_of)
+
+    if as_of is not None:
+        statement = record_state_as_of_statement(
+            select(RecordState, raw_data_column), logbook_key, record_key, as_of
+        )
+    elif record_state_id == "latest":
+        statement = latest_record_state_statement(
+            select(RecordState, raw_data_column).join(
+                RecordHead, RecordHead.latest_state_id == RecordState.id
+            ),
+            logbook_key,
+            record_key,
+        )
+    else:
+        statement = (
+            filter_by_logbook(select(RecordState, raw_data_column), logbook_key)
+            .where(RecordState.key == record_key)
+            .where(RecordState.id == record_state_id)
+        )
+
+    row = db.exec(statement.options(defer(RecordState.data))).first()
+
+    if not row:
+        get_cached_logbook(db, logbook_key)
+
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    return load_record_state_json_data(db, *row)
+
+
+def load_record_state_json_data(
+    db: Session, record_state: RecordState, raw_data: str | None
+):
+    """The data of a single state, as JSON text where it is stored as such."""
+    if record_state.blob_hash is not None:
+        return record_state, load_record_state_blob(db, record_state.blob_hash)
+
+    if record_state.patch is not None:
+        return load_record_state_data(db, record_state), None
+
+    return record_state, raw_data
+
+
+def check_as_of(record_state_id: UUID | Literal["latest"], as_of: datetime | None):
+    if as_of is not None and record_state_id != "latest":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="as_of only applies to the latest state",
+        )
+
+
+def get_record_state_as_of(
+    db: Session, logbook_key: str, record_key: str, as_of: datetime
+):
+    state = db.exec(
+        record_state_as_of_statement(
+            select(RecordState), logbook_key, record_key, as_of
+        )
+    ).first()
+
+    if not state:
+        get_cached_logbook(db, logbook_key)
+
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    return load_record_state_data(db, state)
+
+
+def record_state_as_of_statement(
+    statement, logbook_key: str, record_key: str, as_of: datetime
+):
+    # The latest state at that time, a seek backwards on the index of the record
+    return (
+        filter_by_logbook(statement, logbook_key)
+        .where(RecordState.key == record_key)
+        .where(RecordState.created_at <= to_local_time(as_of))
+        .order_by(RecordState.created_at.desc(), RecordState.id.desc())
+        .limit(1)
+    )
+
+
+def find_record_states_as_of(
+    db: Session,
+    logbook_key: str,
+    as_of: datetime | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+):
+    """The state of every record at a time, with the data of keyframes as JSON
+    text, ordered by record key."""
+    logbook = get_cached_logbook(db, logbook_key)
+
+    statement = (
+        select(RecordState, raw_data_column)
+        .select_from(RecordHead)
+        .where(RecordHead.logbook_id == logbook.id)
+        .order_by(RecordHead.key)
+    )
+
+    if as_of is None:
+        statement = statement.join(
+            RecordState, RecordState.id == RecordHead.latest_state_id
+        )
+    else:
+        as_of = to_local_time(as_of)
+        earlier_state = aliased(RecordState)
+
+        # One seek per record on the index, instead of reading all their states
+        state_as_of = (
+            select(earlier_state.id)
+            .where(earlier_state.logbook_id == RecordHead.logbook_id)
+            .where(earlier_state.key == RecordHead.key)
+            .where(earlier_state.created_at <= as_of)
+            .order_by(earlier_state.created_at.desc(), earlier_state.id.desc())
+            .limit(1)
+            .correlate(RecordHead)
+            .scalar_subquery()
+        )
+
+        statement = statement.join(RecordState, RecordState.id == state_as_of).where(
+            RecordHead.first_created_at <= as_of
+        )
+
+    if after is not None:
+        statement = statement.where(RecordHead.key > after)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    rows = db.exec(statement.options(defer(RecordState.data))).all()
+
+    # The states belong to different records, each patch needs its own keyframe
+    return [load_record_state_json_data(db, *row) for row in rows]
+
+
+def get_latest_record_state(db: Session, logbook_key: str, record_key: str):
+    state = db.exec(
+        latest_record_state_statement(
+            select(RecordState).join(
+                RecordHead, RecordHead.latest_state_id == RecordState.id
+            ),
+            logbook_key,
+            record_key,
+        )
+    ).first()
+
+    if not state:
+        get_cached_logbook(db, logbook_key)
+        return None
+
+    return load_record_state_data(db, state)
+
+
+def find_latest_record_states(db: Session, logbook_id: UUID, record_keys: set[str]):
+    latest_record_states = {}
+    record_keys = list(record_keys)
+
+    # Chunked, the amount of bound parameters is limited
+    for i in range(0, len(record_keys), settings.DATABASE_STREAM_BATCH_SIZE):
+        statement = (
+            select(RecordState)
+            .join(RecordHead, RecordHead.latest_state_id == RecordState.id)
+            .where(RecordHead.logbook_id == logbook_id)
+            .where(
+                RecordHead.key.in_(
+                    record_keys[i : i + settings.DATABASE_STREAM_BATCH_SIZE]
+                )
+            )
+        )
+
+        for record_state in db.exec(statement):
+            latest_record_states[record_state.key] = load_record_state_data(
+                db, record_state
+            )
+
+    return latest_record_states
+
+
+def get_latest_record_state_hash(db: Session, logbook_key: str, record_key: str):
+    statement = latest_record_state_statement(
+        select(RecordHead.latest_hash), logbook_key, record_key
+    )
+
+    return db.exec(statement).first()
+
+
+def get_record_etag(db: Session, logbook_key: str, record_key: str):
+    """ETag of everything read from a record, from its head only.
+
+    The revision covers changes to states other than the latest one.
+    """
+    record_head = db.exec(
+        latest_record_state_statement(select(RecordHead), logbook_key, record_key)
+    ).first()
+
+    if record_head is None:
+        return None
+
+    return generate_etag(
+        record_head.latest_state_id,
+        record_head.latest_hash,
+        record_head.last_created_at.isoformat(),
+        record_head.revision,
+    )
+
+
+def latest_record_state_statement(statement, logbook_key: str, record_key: str):
+    # The record head points at the latest state, no need to search for it
+    return (
+        statement.join(Logbook, Logbook.id == RecordHead.logbook_id)
+        .where(Logbook.key == logbook_key)
+        .where(RecordHead.key == record_key)
+    )
+
+
+def get_latest_record_state_or_raise(db: Session, logbook_key: str, record_key: str):
+    state = get_latest_record_state(db, logbook_key, record_key)
+
+    if not state:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    return state
+
+
+def find_record_states(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    record_states = db.exec(
+        record_states_statement(logbook_key, record_key, after, limit)
+    ).all()
+
+    if not record_states:
+        get_cached_logbook(db, logbook_key)
+
+        if after is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
+            )
+
+    return list(load_record_states_data(db, record_states))
+
+
+def iter_record_states(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    # yield_per makes the driver use a server-side cursor, so only one batch of
+    # states is held in memory at a time
+    return load_record_states_data(
+        db,
+        db.exec(
+            record_states_statement(
+                logbook_key, record_key, after, limit
+            ).execution_options(yield_per=settings.DATABASE_STREAM_BATCH_SIZE)
+        ),
+    )
+
+
+def find_record_states_json(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    """Like find_record_states, with the data of keyframes as JSON text."""
+    rows = db.exec(
+        record_states_statement(
+            logbook_key, record_key, after, limit, (RecordState, raw_data_column)
+        ).options(defer(RecordState.data))
+    ).all()
+
+    if not rows:
+        get_cached_logbook(db, logbook_key)
+
+        if after is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
+            )
+
+    return list(load_record_states_json_data(db, rows))
+
+
+def iter_record_states_json(
+    db: Session,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    return load_record_states_json_data(
+        db,
+        db.exec(
+            record_states_statement(
+                logbook_key, record_key, after, limit, (RecordState, raw_data_column)
+            )
+            .options(defer(RecordState.data))
+            .execution_options(yield_per=settings.DATABASE_STREAM_BATCH_SIZE)
+        ),
+    )
+
+
+def find_logbook_changes(
+    db: Session,
+    logbook_key: str,
+    until: datetime,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    """Finds the states of all records of a logbook in the order they were created,
+    up to a time, with the data of keyframes as JSON text."""
+    logbook = get_cached_logbook(db, logbook_key)
+
+    statement = (
+        select(RecordState, raw_data_column)
+        .where(RecordState.logbook_id == logbook.id)
+        .where(RecordState.created_at <= until)
+        .order_by(RecordState.created_at, RecordState.id)
+        .options(defer(RecordState.data))
+    )
+
+    if after is not None:
+        statement = statement.where(
+            tuple_(RecordState.created_at, RecordState.id) > tuple_(*after)
+        )
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return list(load_logbook_changes_json_data(db, db.exec(statement).all()))
+
+
+def find_field_changes(db: Session, logbook_key: str, record_key: str, path: str):
+    """Finds the states where the value at a path of the data changed.
+
+    Only the stored diffs are read for all states, the data is only loaded for
+    the states where they touch the path.
+    """
+    try:
+        path_tokens = parse_diff_path(path)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid path"
+        )
+
+    changes = []
+    # Whether the path exists and the hash of its value, as of the last change
+    current = (False, None)
+    after = None
+
+    while True:
+        rows = db.exec(
+            record_states_statement(
+                logbook_key,
+                record_key,
+                after,
+                settings.DATABASE_STREAM_BATCH_SIZE,
+                columns=(
+                    RecordState.id,
+                    RecordState.created_at,
+                    RecordState.diff_to_previous,
+                ),
+            )
+        ).all()
+
+        if not rows and after is None:
+            get_cached_logbook(db, logbook_key)
+
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Record not found"
+            )
+
+        # The first state has no diff, the others one only if something changed
+        changed_ids = [
+            row.id
+            for row in rows
+            if (after is None and row is rows[0])
+            or (
+                row.diff_to_previous
+                and diff_touches_path(row.diff_to_previous, path_tokens)
+            )
+        ]
+
+        if changed_ids:
+            record_states = db.exec(
+                select(RecordState)
+                .where(RecordState.id.in_(changed_ids))
+                .order_by(RecordState.created_at, RecordState.id)
+            ).all()
+
+            for record_state in record_states:
+                exists, value = get_path_value(
+                    load_record_state_data(db, record_state).data, path_tokens
+                )
+
+                state = (exists, generate_hash(value) if exists else None)
+
+                # A change of a parent or a list doesn't have to change the value
+                if state == current:
+                    continue
+
+                current = state
+                changes.append(
+                    RecordFieldChange(
+                        record_state_id=record_state.id,
+                        created_at=record_state.created_at,
+                        exists=exists,
+                        value=value,
+                    )
+                )
+
+        if len(rows) < settings.DATABASE_STREAM_BATCH_SIZE:
+            return changes
+
+        after = (rows[-1].created_at, rows[-1].id)
+
+
+def record_states_statement(
+    logbook: UUID | str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+    columns: tuple = (RecordState,),
+):
+    statement = (
+        filter_by_logbook(select(*columns), logbook)
+        .where(RecordState.key == record_key)
+        .order_by(RecordState.created_at, RecordState.id)
+    )
+
+    if after is not None:
+        statement = statement.where(
+            tuple_(RecordState.created_at, RecordState.id) > tuple_(*after)
+        )
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return statement
+
+
+def filter_by_logbook(statement, logbook: UUID | str):
+    """Filters record states by logbook id, or by key joining the logbook, which
+    saves the round trip of looking the logbook up first."""
+    if isinstance(logbook, UUID):
+        return statement.where(RecordState.logbook_id == logbook)
+
+    return statement.join(Logbook, Logbook.id == RecordState.logbook_id).where(
+        Logbook.key == logbook
+    )
+
+
+def find_previous_record_state(db: Session, record_state: RecordState):
+    statement = (
+        select(RecordState)
+        .where(RecordState.logbook_id == record_state.logbook_id)
+        .where(RecordState.key == record_state.key)
+        .where(
+            tuple_(RecordState.created_at, RecordState.id)
+            < tuple_(record_state.created_at, record_state.id)
+        )
+        .order_by(RecordState.created_at.desc(), RecordState.id.desc())
+        .limit(1)
+    )
+    previous_record_state = db.exec(statement).first()
+
+    return (
+        load_record_state_data(db, previous_record_state)
+        if previous_record_state
+        else None
+    )
+
+
+def find_next_record_state(db: Session, record_state: RecordState):
+    statement = (
+        select(RecordState)
+        .where(RecordState.logbook_id == record_state.logbook_id)
+        .where(RecordState.key == record_state.key)
+        .where(
+            tuple_(RecordState.created_at, RecordState.id)
+            > tuple_(record_state.created_at, record_state.id)
+        )
+        .order_by(RecordState.created_at, RecordState.id)
+        .limit(1)
+    )
+
+    next_record_state = db.exec(statement).first()
+
+    return load_record_state_data(db, next_record_state) if next_record_state else None
+
+
+def store_record_state_data(
+    record_state: RecordState,
+    data: dict | list,
+    keyframe_interval: int | None,
+    previous_data: dict | list | None,
+    previous_keyframe_distance: int,
+):
+    if (
+        keyframe_interval
+        and previous_data is not None
+        and previous_keyframe_distance + 1 < keyframe_interval
+    ):
+        record_state.data = None
+        record_state.patch = generate_patch(previous_data, data)
+        record_state.keyframe_distance = previous_keyframe_distance + 1
+    else:
+        record_state.data = data
+        record_state.patch = None
+        record_state.keyframe_distance = 0
+
+
+def rebase_record_state(
+    record_state: RecordState, previous_record_state: RecordState | None
+):
+    record_state.diff_to_previous = generate_diff_to_previous(
+        previous_record_state, record_state
+    )
+    store_record_state_keyframe(record_state)
+
+
+def store_record_state_keyframe(record_state: RecordState):
+    # Expects the data to be loaded already
+    if record_state.patch is not None:
+        flag_modified(record_state, "data")
+        record_state.patch = None
+        record_state.keyframe_distance = 0
+
+
+def load_record_state_data(db: Session, record_state: RecordState):
+    """Rebuilds the data of a state stored as a patch from its keyframe, or loads
+    it from its blob."""
+    if record_state.blob_hash is not None:
+        set_committed_value(
+            record_state,
+            "data",
+            orjson.loads(load_record_state_blob(db, record_state.blob_hash)),
+        )
+        return record_state
+
+    if record_state.patch is None:
+        return record_state
+
+    # Deleting states can only shorten the chain, the keyframe is always in reach
+    statement = (
+        select(RecordState.data, RecordState.patch, RecordState.blob_hash)
+        .where(RecordState.logbook_id == record_state.logbook_id)
+        .where(RecordState.key == record_state.key)
+        .where(
+            tuple_(RecordState.created_at, RecordState.id)
+            < tuple_(record_state.created_at, record_state.id)
+        )
+        .order_by(RecordState.created_at.desc(), RecordState.id.desc())
+        .limit(record_state.keyframe_distance)
+    )
+
+    patches = []
+
+    # Ends with data holding the keyframe
+    for data, patch, blob_hash in db.exec(statement):
+        if patch is None:
+            break
+
+        patches.append(patch)
+
+    if blob_hash is not None:
+        data = orjson.loads(load_record_state_blob(db, blob_hash))
+
+    for patch in reversed(patches):
+        data = apply_patch(data, patch)
+
+    set_committed_value(record_state, "data", apply_patch(data, record_state.patch))
+
+    return record_state
+
+
+def load_record_states_json_data(
+    db: Session, rows: Iterable[tuple[RecordState, str | None]]
+):
+    """Like load_record_states_data, for states with the data of keyframes as JSON
+    text. A keyframe is only parsed if a patch follows it."""
+    data = None
+    keyframe_raw_data = None
+
+    for record_state, raw_data in rows:
+        if record_state.blob_hash is not None:
+            raw_data = load_record_state_blob(db, record_state.blob_hash)
+
+        if record_state.patch is None:
+            data = None
+            keyframe_raw_data = raw_data
+        elif data is None and keyframe_raw_data is None:
+            data = load_record_state_data(db, record_state).data
+        else:
+            if data is None:
+                data = orjson.loads(keyframe_raw_data)
+
+            data = apply_patch(data, record_state.patch)
+            set_committed_value(record_state, "data", data)
+
+        yield record_state, raw_data
+
+
+def load_logbook_changes_json_data(
+    db: Session, rows: Iterable[tuple[RecordState, str | None]]
+):
+    """Like load_record_states_json_data, for the states of many records mixed
+    together, one chain of patches per record."""
+    chains: dict[str, tuple[Any, str | None]] = {}
+
+    for record_state, raw_data in rows:
+        if record_state.blob_hash is not None:
+            raw_data = load_record_state_blob(db, record_state.blob_hash)
+
+        if record_state.patch is None:
+            chains[record_state.key] = (None, raw_data)
+            yield record_state, raw_data
+            continue
+
+        data, keyframe_raw_data = chains.get(record_state.key, (None, None))
+
+        if data is None and keyframe_raw_data is None:
+            data = load_record_state_data(db, record_state).data
+        else:
+            if data is None:
+                data = orjson.loads(keyframe_raw_data)
+
+            data = apply_patch(data, record_state.patch)
+            set_committed_value(record_state, "data", data)
+
+        chains[record_state.key] = (data, None)
+
+        yield record_state, raw_data
+
+
+def load_record_states_data(db: Session, record_states: Iterable[RecordState]):
+    """Rebuilds the data of consecutive states of a record, one patch at a time."""
+    data = None
+
+    for record_state in record_states:
+        if record_state.blob_hash is not None or (
+            record_state.patch is not None and data is None
+        ):
+            data = load_record_state_data(db, record_state).data
+        elif record_state.patch is None:
+            data = record_state.data
+        else:
+            data = apply_patch(data, record_state.patch)
+            set_committed_value(record_state, "data", data)
 
-    return record_states
+        yield record_state
@@ -0,0 +1,416 @@
+"""Async versions of the crud functions used by the API.
+
+Queries run on the async engine through ``run_sync``, so the sync crud functions
+are reused as they are. Diffing, hashing and patching is moved to the threadpool
+instead, it would otherwise block the event loop for large states.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from uuid import UUID
+from typing import Literal
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud
+from app.api.routes.schemas import RecordQuery
+from app.models import (
+    IngestionEntry,
+    LogbookBase,
+    LogbookRetention,
+    RecordState,
+    RecordStateBase,
+    RecordStateBulkCreate,
+    RecordStateCreate,
+)
+
+from .utils import generate_hash
+
+
+async def create_logbook(db: AsyncSession, new_logbook: LogbookBase):
+    return await db.run_sync(crud.create_logbook, new_logbook)
+
+
+async def get_cached_logbook(db: AsyncSession, key: str):
+    logbook = crud.logbook_cache.get(key)
+
+    if logbook is None:
+        logbook = await db.run_sync(crud.get_cached_logbook, key)
+
+    return logbook
+
+
+async def update_logbook_retention(
+    db: AsyncSession, key: str, logbook_retention: LogbookRetention
+):
+    return await db.run_sync(crud.update_logbook_retention, key, logbook_retention)
+
+
+async def delete_logbook(db: AsyncSession, key: str):
+    await db.run_sync(crud.delete_logbook, key)
+
+
+async def find_all_logbooks(db: AsyncSession):
+    return await db.run_sync(crud.find_all_logbooks)
+
+
+async def find_all_record_keys(
+    db: AsyncSession,
+    logbook_key: str,
+    prefix: str | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_all_record_keys, logbook_key, prefix, after, limit
+    )
+
+
+async def find_matching_records(
+    db: AsyncSession,
+    logbook_key: str,
+    query: RecordQuery,
+    after: str | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_matching_records, logbook_key, query, after, limit
+    )
+
+
+async def delete_record(db: AsyncSession, logbook_key: str, record_key: str):
+    await db.run_sync(crud.delete_record, logbook_key, record_key)
+
+
+async def create_purge_job(
+    db: AsyncSession, logbook_key: str, record_key: str | None = None
+):
+    return await db.run_sync(crud.create_purge_job, logbook_key, record_key)
+
+
+async def get_purge_job(db: AsyncSession, purge_job_id: UUID):
+    return await db.run_sync(crud.get_purge_job, purge_job_id)
+
+
+async def create_record_state(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    new_record_state: RecordStateCreate,
+    prevent_no_changes: bool = False,
+):
+    logbook = await get_cached_logbook(db, logbook_key)
+    await db.run_sync(crud.lock_records, logbook.id, [record_key])
+
+    hash = await run_in_threadpool(generate_hash, new_record_state.data)
+
+    # Most pushes are unchanged, so check the hash before loading the previous state
+    if (
+        prevent_no_changes
+        and await db.run_sync(
+            crud.get_latest_record_state_hash, logbook_key, record_key
+        )
+        == hash
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="No changes detected",
+        )
+
+    previous_record_state = await get_latest_record_state(
+        db, logbook_key, record_key
+    )
+
+    record_state = await run_in_threadpool(
+        crud.build_record_state,
+        logbook,
+        record_key,
+        new_record_state,
+        hash,
+        previous_record_state,
+    )
+
+    db.add(record_state)
+    await db.run_sync(crud.update_record_heads, [crud.record_state_row(record_state)])
+    await db.commit()
+    await db.refresh(record_state)
+    set_committed_value(record_state, "data", new_record_state.data)
+
+    return record_state
+
+
+async def create_record_states(
+    db: AsyncSession,
+    logbook_key: str,
+    new_record_states: list[RecordStateBulkCreate],
+    prevent_no_changes: bool = False,
+):
+    logbook = await get_cached_logbook(db, logbook_key)
+    await db.run_sync(
+        crud.lock_records, logbook.id, [new.record_key for new in new_record_states]
+    )
+
+    latest_record_states = await db.run_sync(
+        crud.find_latest_record_states,
+        logbook.id,
+        {new.record_key for new in new_record_states},
+    )
+
+    results, rows = await run_in_threadpool(
+        crud.build_record_states,
+        logbook,
+        new_record_states,
+        latest_record_states,
+        prevent_no_changes,
+    )
+
+    await insert_record_states(db, rows)
+    await db.run_sync(crud.update_record_heads, rows)
+    await db.commit()
+
+    return results
+
+
+async def create_journaled_record_states(
+    db: AsyncSession, entries: list[IngestionEntry]
+):
+    """Stores states of the ingestion journal, returns how many were stored."""
+    existing_ids = await db.run_sync(
+        crud.find_existing_record_state_ids, [entry.id for entry in entries]
+    )
+
+    entries_by_logbook = defaultdict(list)
+
+    for entry in entries:
+        entries_by_logbook[entry.logbook_key].append(entry)
+
+    rows = []
+
+    for logbook_key, logbook_entries in entries_by_logbook.items():
+        logbook = await db.run_sync(crud.find_logbook, logbook_key)
+
+        # Deleted after the states were accepted
+        if logbook is None:
+            continue
+
+        await db.run_sync(
+            crud.lock_records,
+            logbook.id,
+            [entry.record_key for entry in logbook_entries],
+        )
+
+        latest_record_states = await db.run_sync(
+            crud.find_latest_record_states,
+            logbook.id,
+            {entry.record_key for entry in logbook_entries},
+        )
+
+        rows += await run_in_threadpool(
+            crud.build_journaled_record_states,
+            logbook,
+            logbook_entries,
+            latest_record_states,
+            existing_ids,
+        )
+
+    await insert_record_states(db, rows)
+    await db.run_sync(crud.update_record_heads, rows)
+    await db.commit()
+
+    return len(rows)
+
+
+async def insert_record_states(db: AsyncSession, rows: list[dict]):
+    if not rows:
+        return
+
+    blobs = await run_in_threadpool(crud.store_record_state_blobs, rows)
+    await db.run_sync(crud.insert_record_state_blobs, blobs)
+
+    if db.bind.dialect.name != "postgresql":
+        await db.execute(insert(RecordState), rows)
+        return
+
+    statement, values = crud.copy_record_states(rows)
+
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+
+    async with raw_connection.driver_connection.cursor() as cursor:
+        async with cursor.copy(statement) as copy:
+            for row in values:
+                await copy.write_row(row)
+
+
+async def update_record_state(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID,
+    updated_record_state: RecordStateBase,
+):
+    logbook = await get_cached_logbook(db, logbook_key)
+    await db.run_sync(crud.lock_records, logbook.id, [record_key])
+
+    record_state = await get_record_state(
+        db, logbook_key, record_key, record_state_id
+    )
+
+    # Load the neighbours before the update is flushed, their data may depend on it
+    previous_record_state = await db.run_sync(
+        crud.find_previous_record_state, record_state
+    )
+    next_record_state = await db.run_sync(crud.find_next_record_state, record_state)
+
+    await run_in_threadpool(
+        crud.apply_record_state_update,
+        record_state,
+        updated_record_state,
+        previous_record_state,
+        next_record_state,
+    )
+    db.add(record_state)
+
+    if next_record_state:
+        db.add(next_record_state)
+
+    await db.exec(crud.updated_record_head_statement(record_state, next_record_state))
+
+    await db.commit()
+    await db.refresh(record_state)
+
+    return await db.run_sync(crud.load_record_state_data, record_state)
+
+
+async def delete_record_state(
+    db: AsyncSession, logbook_key: str, record_key: str, record_state_id: UUID
+):
+    record_state = await get_record_state(
+        db, logbook_key, record_key, record_state_id
+    )
+
+    if not record_state:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Record state not found"
+        )
+
+    previous_record_state = await db.run_sync(
+        crud.find_previous_record_state, record_state
+    )
+    next_record_state = await db.run_sync(crud.find_next_record_state, record_state)
+
+    if next_record_state:
+        # The next state now follows the one before the deleted state
+        await run_in_threadpool(
+            crud.rebase_record_state, next_record_state, previous_record_state
+        )
+        db.add(next_record_state)
+
+    await db.run_sync(
+        crud.remove_from_record_head,
+        record_state,
+        previous_record_state,
+        next_record_state,
+    )
+    await db.delete(record_state)
+    await db.commit()
+
+
+async def get_record_state(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID | Literal["latest"],
+    as_of: datetime | None = None,
+):
+    return await db.run_sync(
+        crud.get_record_state, logbook_key, record_key, record_state_id, as_of
+    )
+
+
+async def get_record_state_json(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    record_state_id: UUID | Literal["latest"],
+    as_of: datetime | None = None,
+):
+    return await db.run_sync(
+        crud.get_record_state_json, logbook_key, record_key, record_state_id, as_of
+    )
+
+
+async def find_record_states_as_of(
+    db: AsyncSession,
+    logbook_key: str,
+    as_of: datetime | None = None,
+    after: str | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_record_states_as_of, logbook_key, as_of, after, limit
+    )
+
+
+async def get_latest_record_state(
+    db: AsyncSession, logbook_key: str, record_key: str
+):
+    return await db.run_sync(crud.get_latest_record_state, logbook_key, record_key)
+
+
+async def get_record_etag(db: AsyncSession, logbook_key: str, record_key: str):
+    return await db.run_sync(crud.get_record_etag, logbook_key, record_key)
+
+
+async def get_latest_record_state_or_raise(
+    db: AsyncSession, logbook_key: str, record_key: str
+):
+    return await db.run_sync(
+        crud.get_latest_record_state_or_raise, logbook_key, record_key
+    )
+
+
+async def find_field_changes(
+    db: AsyncSession, logbook_key: str, record_key: str, path: str
+):
+    return await db.run_sync(crud.find_field_changes, logbook_key, record_key, path)
+
+
+async def find_record_states(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_record_states, logbook_key, record_key, after, limit
+    )
+
+
+async def find_record_states_json(
+    db: AsyncSession,
+    logbook_key: str,
+    record_key: str,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_record_states_json, logbook_key, record_key, after, limit
+    )
+
+
+async def find_logbook_changes(
+    db: AsyncSession,
+    logbook_key: str,
+    until: datetime,
+    after: tuple[datetime, UUID] | None = None,
+    limit: int | None = None,
+):
+    return await db.run_sync(
+        crud.find_logbook_changes, logbook_key, until, after, limit
+    )
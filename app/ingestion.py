@@ -0,0 +1,306 @@
+"""Write-behind ingestion through a journal file.
+
+With INGESTION_JOURNAL_PATH set, new states are appended to the journal and
+acknowledged once it is synced to disk, concurrent requests share one fsync.
+One worker at a time runs the flusher, which stores the states in batches and
+records its progress next to the journal. Entries keep the id they were
+accepted with, so after a crash the ones stored already are skipped.
+
+All workers of a host append to the same journal. Reads that have to see the
+states accepted before them wait until the flusher got past the end of the
+journal.
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud_async
+from app.core.config import settings
+from app.core.db import async_transaction_engine
+from app.core.metrics import (
+    ingestion_flushed_states,
+    ingestion_lag,
+    ingestion_pending_bytes,
+)
+from app.models import IngestionEntry, RecordState, RecordStateCreate
+from app.utils import generate_hash
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionJournal:
+    def __init__(self, path: str):
+        self.path = path
+        # Positions count all bytes ever appended, the journal is emptied once
+        # everything in it is stored
+        self.position_path = f"{path}.position"
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.flusher_lock = open(f"{path}.flusher.lock", "w")
+        self.is_flusher = False
+        self.pending: list[tuple[bytes, asyncio.Future]] = []
+        self.writing: asyncio.Task | None = None
+
+    async def accept(
+        self,
+        db: AsyncSession,
+        logbook_key: str,
+        record_key: str,
+        new_record_state: RecordStateCreate,
+        prevent_no_changes: bool = False,
+    ):
+        """Appends a new state, returns it like it will be stored, without the diff.
+
+        Unchanged states are dropped by the flusher, there is no previous state
+        to compare with yet.
+        """
+        logbook = await crud_async.get_cached_logbook(db, logbook_key)
+
+        entry = IngestionEntry(
+            logbook_key=logbook_key,
+            record_key=record_key,
+            data=new_record_state.data,
+            meta=new_record_state.meta,
+            hash=await run_in_threadpool(generate_hash, new_record_state.data),
+            prevent_no_changes=prevent_no_changes,
+        )
+
+        await self.append(entry.model_dump_json().encode() + b"\n")
+
+        return RecordState(
+            id=entry.id,
+            key=record_key,
+            logbook_id=logbook.id,
+            created_at=entry.created_at,
+            hash=entry.hash,
+            data=entry.data,
+            meta=entry.meta,
+        )
+
+    async def append(self, line: bytes):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((line, future))
+
+        if self.writing is None or self.writing.done():
+            self.writing = asyncio.create_task(self.write_pending())
+
+        await future
+
+    async def write_pending(self):
+        # Lines appended while a write is synced go together with the next one
+        while self.pending:
+            pending, self.pending = self.pending, []
+
+            try:
+                await run_in_threadpool(self.write, b"".join(line for line, _ in pending))
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_result(None)
+
+    def write(self, lines: bytes):
+        with self.locked(fcntl.LOCK_EX):
+            size = os.fstat(self.fd).st_size
+
+            # A write cut short by a crash would run into the first line
+            if size and os.pread(self.fd, 1, size - 1) != b"\n":
+                lines = b"\n" + lines
+
+            os.write(self.fd, lines)
+            os.fsync(self.fd)
+
+    @contextmanager
+    def locked(self, operation: int):
+        fcntl.flock(self.fd, operation)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def read_position(self) -> tuple[int, int]:
+        """Position the flusher got to, and where the journal starts."""
+        try:
+            with open(self.position_path) as file:
+                position = json.load(file)
+        except (FileNotFoundError, ValueError):
+            # Starts over, the entries stored already are skipped
+            return 0, 0
+
+        return position["flushed"], position["start"]
+
+    def write_position(self, flushed: int, start: int):
+        with open(f"{self.position_path}.tmp", "w") as file:
+            json.dump({"flushed": flushed, "start": start}, file)
+
+        os.replace(f"{self.position_path}.tmp", self.position_path)
+
+    def end(self) -> int:
+        with self.locked(fcntl.LOCK_SH):
+            _, start = self.read_position()
+
+            return start + os.fstat(self.fd).st_size
+
+    async def wait_until_flushed(self):
+        end = await run_in_threadpool(self.end)
+        deadline = time.monotonic() + settings.INGESTION_READ_TIMEOUT
+
+        while self.read_position()[0] < end:
+            if time.monotonic() > deadline:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Ingestion journal is behind",
+                )
+
+            await asyncio.sleep(settings.INGESTION_FLUSH_INTERVAL)
+
+    def read_entries(self) -> tuple[list[IngestionEntry], int, int]:
+        flushed, start = self.read_position()
+        entries = []
+
+        with open(self.path, "rb") as file:
+            file.seek(flushed - start)
+
+            for line in file:
+                # Not completely written yet
+                if not line.endswith(b"\n"):
+                    break
+
+                flushed += len(line)
+
+                if not line.strip():
+                    continue
+
+                try:
+                    entries.append(IngestionEntry.model_validate_json(line))
+                except ValidationError:
+                    logger.warning("Skipping an invalid ingestion journal entry")
+
+                if len(entries) >= settings.INGESTION_FLUSH_BATCH_SIZE:
+                    break
+
+        return entries, flushed, start + os.fstat(self.fd).st_size
+
+    def commit_position(self, flushed: int):
+        with self.locked(fcntl.LOCK_EX):
+            _, start = self.read_position()
+            size = os.fstat(self.fd).st_size
+
+            if flushed < start + size:
+                self.write_position(flushed, start)
+                return
+
+            # Everything is stored, the position goes first, a crash in between
+            # only makes the stored entries be skipped again
+            self.write_position(flushed, flushed)
+            os.ftruncate(self.fd, 0)
+
+    async def flush(self) -> int:
+        entries, flushed, end = await run_in_threadpool(self.read_entries)
+
+        ingestion_pending_bytes.set(end - flushed)
+        ingestion_lag.set(
+            (datetime.now() - entries[0].created_at).total_seconds() if entries else 0
+        )
+
+        if entries:
+            async with AsyncSession(
+                async_transaction_engine, expire_on_commit=False
+            ) as db:
+                stored = await crud_async.create_journaled_record_states(db, entries)
+
+            ingestion_flushed_states.inc(stored)
+
+        if flushed != self.read_position()[0]:
+            await run_in_threadpool(self.commit_position, flushed)
+
+        return len(entries)
+
+    async def run_flusher(self):
+        while True:
+            try:
+                if not self.is_flusher:
+                    self.is_flusher = try_lock(self.flusher_lock)
+
+                # A full batch means there is more waiting
+                if (
+                    self.is_flusher
+                    and await self.flush() >= settings.INGESTION_FLUSH_BATCH_SIZE
+                ):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Flushing the ingestion journal failed")
+
+            await asyncio.sleep(settings.INGESTION_FLUSH_INTERVAL)
+
+    async def close(self):
+        if self.writing is not None:
+            await self.writing
+
+        # Leaves nothing behind for the next start, if this worker is the flusher
+        if self.is_flusher:
+            while await self.flush():
+                pass
+
+        self.flusher_lock.close()
+        os.close(self.fd)
+
+
+def try_lock(file) -> bool:
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+
+    return True
+
+
+journal: IngestionJournal | None = None
+flusher: asyncio.Task | None = None
+
+
+def start_ingestion():
+    global journal, flusher
+
+    if settings.INGESTION_JOURNAL_PATH:
+        journal = IngestionJournal(settings.INGESTION_JOURNAL_PATH)
+        flusher = asyncio.create_task(journal.run_flusher())
+
+
+async def stop_ingestion():
+    global journal, flusher
+
+    if flusher is not None:
+        flusher.cancel()
+
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+
+    if journal is not None:
+        await journal.close()
+
+    journal = None
+    flusher = None
+
+
+async def wait_until_flushed():
+    if journal is not None:
+        await journal.wait_until_flushed()
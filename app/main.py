@@ -1,6 +1,13 @@
 from fastapi import FastAPI
 
 from app.api.main import api_router
+from app.api.middleware import (
+    CompressionMiddleware,
+    MetricsMiddleware,
+    RequestDecompressionMiddleware,
+)
+from app.api.responses import ORJSONResponse
+from app.api.routes import metrics
 from app.core.config import settings
 from app.startup import lifespan
 
@@ -13,6 +20,18 @@ app = FastAPI(
     # openapi_url=f"{settings.API_V1_STR}/openapi.json",
     # generate_unique_id_function=custom_generate_unique_id,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+app.add_middleware(
+    CompressionMiddleware, minimum_size=settings.RESPONSE_COMPRESSION_MINIMUM_SIZE
+)
+app.add_middleware(
+    RequestDecompressionMiddleware, max_size=settings.REQUEST_MAX_BODY_SIZE
 )
+# Added last to run first, sees the time of and the bytes after all the others
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
+# Where Prometheus looks by default, outside of the versioned API
+app.include_router(metrics.router)
@@ -1,19 +1,34 @@
 import uuid
 from datetime import datetime
 
-from sqlmodel import JSON, Field, SQLModel, UniqueConstraint
+from sqlalchemy import LargeBinary, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import JSON, Field, Index, SQLModel, UniqueConstraint
 
+# jsonb on Postgres, so the content can be indexed and queried
+JSONContent = JSON().with_variant(JSONB(), "postgresql")
 
-class LogbookBase(SQLModel):
+
+class LogbookRetention(SQLModel):
+    # Enforced by the compactor, the latest state of a record is always kept
+    retention_max_states: int | None = Field(default=None, ge=1)
+    retention_max_age_days: int | None = Field(default=None, ge=1)
+    # Only the last state of each day is kept of states older than this
+    retention_thin_after_days: int | None = Field(default=None, ge=1)
+
+
+class LogbookBase(LogbookRetention):
     key: str = Field(max_length=255, unique=True, index=True)
+    # Store a full keyframe every n states and JSON patches in between
+    keyframe_interval: int | None = Field(default=None, ge=1)
 
 
 class Logbook(LogbookBase, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
 
 class RecordStateBase(SQLModel):
-    data: dict | list = Field(sa_type=JSON)
-    meta: dict = Field(default={}, sa_type=JSON)
+    data: dict | list = Field(sa_type=JSONContent)
+    meta: dict = Field(default={}, sa_type=JSONContent)
 
     class Config:
         arbitrary_types_allowed = True
@@ -23,16 +38,125 @@ class RecordStateCreate(RecordStateBase):
     created_at: datetime | None = Field(default=None)
 
 
+class RecordStateBulkCreate(RecordStateCreate):
+    record_key: str = Field(max_length=255)
+
+
+class IngestionEntry(RecordStateBulkCreate):
+    """A state accepted by the ingestion journal, stored later by the flusher."""
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4)
+    logbook_key: str
+    created_at: datetime = Field(default_factory=datetime.now)
+    hash: str
+    prevent_no_changes: bool = False
+
+
 class RecordState(RecordStateBase, table=True):
     __tablename__: str = "record_state"
     
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     key: str = Field(max_length=255)
-    logbook_id: uuid.UUID = Field(foreign_key="logbook.id")
+    logbook_id: uuid.UUID = Field(foreign_key="logbook.id", ondelete="CASCADE")
     created_at: datetime = Field(
         default_factory=datetime.now,
     )
+    hash: str | None = Field(default=None, max_length=64)
+    diff_to_previous: dict | None = Field(default=None, sa_type=JSON)
+
+    # Only keyframes hold the data, the states in between a patch to the previous one
+    data: dict | list = Field(
+        sa_type=JSON(none_as_null=True).with_variant(
+            JSONB(none_as_null=True), "postgresql"
+        ),
+        nullable=True,
+    )
+    patch: list | None = Field(
+        default=None, sa_type=JSON(none_as_null=True), exclude=True
+    )
+    keyframe_distance: int = Field(default=0, exclude=True)
+    # Large data is stored compressed in the blob table instead, by its hash
+    blob_hash: str | None = Field(
+        default=None,
+        max_length=64,
+        foreign_key="record_state_blob.hash",
+        exclude=True,
+    )
 
     __table_args__ = (
         UniqueConstraint("logbook_id", "key", "created_at", name="uq_record_state"),
+        # Serves the latest state and history pages in index order, on Postgres
+        # the latest hash is read from the index alone
+        Index(
+            "ix_record_state_latest",
+            "logbook_id",
+            "key",
+            "created_at",
+            "id",
+            postgresql_include=["hash"],
+        ),
+        # The change feed of a logbook, in the order the states were created
+        Index("ix_record_state_feed", "logbook_id", "created_at", "id"),
+        # Finds the blobs no state refers to anymore
+        Index(
+            "ix_record_state_blob_hash",
+            "blob_hash",
+            postgresql_where=text("blob_hash IS NOT NULL"),
+            sqlite_where=text("blob_hash IS NOT NULL"),
+        ),
+        # Containment and JSON path queries on the content
+        *(
+            Index(
+                f"ix_record_state_{column}",
+                column,
+                postgresql_using="gin",
+                postgresql_ops={column: "jsonb_path_ops"},
+            ).ddl_if(dialect="postgresql")
+            for column in ("data", "meta")
+        ),
     )
+
+
+class RecordStateBlob(SQLModel, table=True):
+    """Data of a large state as zstd compressed JSON, stored once per content hash."""
+
+    __tablename__: str = "record_state_blob"
+
+    hash: str = Field(max_length=64, primary_key=True)
+    # Of the JSON, before it was compressed
+    size: int
+    content: bytes = Field(sa_type=LargeBinary)
+
+
+class RecordHead(SQLModel, table=True):
+    """Latest state and state count of a record, maintained on every write."""
+
+    __tablename__: str = "record_head"
+
+    logbook_id: uuid.UUID = Field(
+        foreign_key="logbook.id", ondelete="CASCADE", primary_key=True
+    )
+    key: str = Field(max_length=255, primary_key=True)
+    latest_state_id: uuid.UUID
+    latest_hash: str | None = Field(default=None, max_length=64)
+    amount_of_states: int
+    first_created_at: datetime
+    last_created_at: datetime
+    # Bumped on every change to the states of the record, part of its ETag
+    revision: int = Field(default=0)
+
+
+class PurgeJob(SQLModel, table=True):
+    __tablename__: str = "purge_job"
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    # No foreign key, the job outlives the logbook it purges
+    logbook_id: uuid.UUID
+    logbook_key: str = Field(max_length=255)
+    # Purges a single record when set, the whole logbook otherwise
+    record_key: str | None = Field(default=None, max_length=255)
+    status: str = Field(default="pending", max_length=16)
+    total_states: int = 0
+    deleted_states: int = 0
+    created_at: datetime = Field(default_factory=datetime.now)
+    finished_at: datetime | None = None
@@ -1,40 +1,47 @@
 import logging
-import os
-import subprocess
-import sys
 
 from fastapi import FastAPI
 from fastapi.concurrency import asynccontextmanager
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session, select
-from tenacity import after_log, before_log, retry, stop_after_attempt, wait_fixed
+from tenacity import after_log, before_log, retry, stop_after_delay, wait_exponential
 
 from app.core.config import settings
-from app.core.db import engine
+from app.core.db import async_engine, async_transaction_engine, engine
+from app.core.metrics import mark_process_dead
+from app.core.migrations import upgrade_database
 from app.crud import create_logbook, find_logbook
+from app.ingestion import start_ingestion, stop_ingestion
 from app.models import LogbookBase
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-db_connect_max_tries = 60 * 5  # 5 minutes
-db_connect_wait_seconds = 1
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     with Session(engine) as db:
         check_db(db)
 
-        run_migrations()
+        if settings.RUN_MIGRATIONS_ON_STARTUP:
+            run_migrations()
 
         create_logbooks(db)
 
-        yield
+    start_ingestion()
+
+    yield
+
+    await stop_ingestion()
+    await async_engine.dispose()
+    await async_transaction_engine.dispose()
+    mark_process_dead()
 
 
 @retry(
-    stop=stop_after_attempt(db_connect_max_tries),
-    wait=wait_fixed(db_connect_wait_seconds),
+    stop=stop_after_delay(settings.DATABASE_CONNECT_TIMEOUT),
+    # Retries quickly at first, a database that is just starting is up soon
+    wait=wait_exponential(multiplier=0.1, max=1),
     before=before_log(logger, logging.INFO),
     after=after_log(logger, logging.WARN),
 )
@@ -48,43 +55,19 @@ def check_db(db: Session):
 
 
 def run_migrations():
-    """
-    Runs Alembic database migrations using sys.executable and module execution.
-
-    This method is more compatible with environments like Vercel where direct
-    command execution might be restricted.
-    """
-    try:
-        # Ensure the current directory is in the Python path
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        sys.path.insert(0, current_dir)
-
-        # Use sys.executable to run the Alembic module
-        result = subprocess.run(
-            [sys.executable, "-m", "alembic", "upgrade", "head"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-
-        # Print the output if there's any
-        if result.stdout:
-            logger.info("Migration output:", result.stdout)
-
+    if upgrade_database(engine):
         logger.info("Migrations completed successfully!")
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Migration failed. Error: {e}")
-        logger.error("Standard output:", e.stdout)
-        logger.error("Standard error:", e.stderr)
-        raise
-    except Exception as e:
-        logger.error(f"An error occurred while running migrations: {e}")
-        raise
+    else:
+        logger.info("Database is up to date")
 
 
 def create_logbooks(db: Session):
     for key in settings.DEFAULT_LOGBOOKS:
         if find_logbook(db, key) is None:
             logger.info(f"Creating default logbook with key: {key}")
-            create_logbook(db, LogbookBase(key=key))
+
+            try:
+                create_logbook(db, LogbookBase(key=key))
+            except IntegrityError:
+                # Created by another worker starting at the same time
+                db.rollback()
@@ -0,0 +1,241 @@
+"""Export and import of whole logbooks as NDJSON, compressed with zstd or gzip.
+
+The first line holds the logbook, every other line a state with its full
+data. The states of a record follow each other, in the order they were
+created, so an import can store them as patches again without looking back.
+
+Both directions stream: an export reads the states through a server-side
+cursor, an import inserts and commits them a batch at a time, with COPY on
+Postgres. Neither holds more than a batch of states in memory.
+"""
+
+import gzip
+import io
+import sys
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from enum import Enum
+from itertools import groupby
+from typing import IO
+
+import orjson
+import zstandard
+from sqlalchemy.orm import defer
+from sqlmodel import Session, select
+
+from app import crud
+from app.core.config import settings
+from app.models import LogbookBase, RecordState
+from app.utils import record_state_data_content
+
+EXPORT_FORMAT_VERSION = 1
+# States between progress reports of an export
+EXPORT_PROGRESS_INTERVAL = 10000
+
+
+class Compression(str, Enum):
+    zstd = "zstd"
+    gzip = "gzip"
+    none = "none"
+
+
+def detect_compression(path: str) -> Compression:
+    if path.endswith(".gz"):
+        return Compression.gzip
+
+    if path.endswith(".ndjson") or path.endswith(".jsonl"):
+        return Compression.none
+
+    return Compression.zstd
+
+
+@contextmanager
+def open_export(
+    path: str, mode: str, compression: Compression | None = None
+) -> Iterator[IO[bytes]]:
+    """Opens an export file for reading ("rb") or writing ("wb"), - is stdin or
+    stdout. Without a compression, it goes by the file extension."""
+    if compression is None:
+        compression = detect_compression(path)
+
+    if path == "-":
+        raw = sys.stdin.buffer if mode == "rb" else sys.stdout.buffer
+    else:
+        raw = open(path, mode)
+
+    try:
+        if compression == Compression.none:
+            yield raw
+        elif compression == Compression.gzip:
+            with gzip.GzipFile(fileobj=raw, mode=mode) as file:
+                yield file
+        elif mode == "rb":
+            with io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            ) as file:
+                yield file
+        else:
+            with zstandard.ZstdCompressor().stream_writer(raw, closefd=False) as file:
+                yield file
+    finally:
+        if path != "-":
+            raw.close()
+        elif mode == "wb":
+            raw.flush()
+
+
+def export_logbook(
+    db: Session,
+    logbook_key: str,
+    file: IO[bytes],
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """Writes a logbook and all its states to a file, returns the amount of states."""
+    logbook = crud.get_logbook(db, logbook_key)
+
+    file.write(
+        orjson.dumps(
+            {
+                "version": EXPORT_FORMAT_VERSION,
+                "logbook": logbook.model_dump(exclude={"id"}),
+            }
+        )
+        + b"\n"
+    )
+
+    # yield_per makes the driver use a server-side cursor, ordered by the
+    # latest state index
+    rows = db.exec(
+        select(RecordState, crud.raw_data_column)
+        .where(RecordState.logbook_id == logbook.id)
+        .order_by(RecordState.key, RecordState.created_at, RecordState.id)
+        .options(defer(RecordState.data))
+        .execution_options(yield_per=settings.DATABASE_STREAM_BATCH_SIZE)
+    )
+
+    exported = 0
+
+    # Patches are applied one record at a time, holding on to its data only
+    for _, record_rows in groupby(rows, key=lambda row: row[0].key):
+        for record_state, raw_data in crud.load_record_states_json_data(
+            db, record_rows
+        ):
+            file.write(orjson.dumps(export_content(record_state, raw_data)) + b"\n")
+            exported += 1
+
+            if progress is not None and exported % EXPORT_PROGRESS_INTERVAL == 0:
+                progress(exported)
+
+    return exported
+
+
+def export_content(record_state: RecordState, raw_data: str | None):
+    return {
+        "id": record_state.id,
+        "key": record_state.key,
+        "created_at": record_state.created_at,
+        "hash": record_state.hash,
+        "meta": record_state.meta,
+        "data": record_state_data_content(record_state, raw_data),
+        "diff_to_previous": record_state.diff_to_previous,
+    }
+
+
+def import_logbook(
+    db: Session,
+    file: IO[bytes],
+    logbook_key: str | None = None,
+    resume: bool = False,
+    progress: Callable[[int], None] | None = None,
+) -> int:
+    """Creates a logbook from an export, keeping the ids and times of the states.
+
+    Each batch is committed on its own, an import that stopped half way is
+    continued with resume, which skips the states stored already. Returns the
+    amount of states stored.
+    """
+    header = orjson.loads(file.readline() or b"null")
+
+    if not isinstance(header, dict) or header.get("version") != EXPORT_FORMAT_VERSION:
+        raise ValueError("Not a logbook export, or one of another version")
+
+    new_logbook = LogbookBase.model_validate(header["logbook"])
+
+    if logbook_key is not None:
+        new_logbook.key = logbook_key
+
+    if resume:
+        logbook = crud.get_logbook(db, new_logbook.key)
+    else:
+        logbook = crud.create_logbook(db, new_logbook)
+
+    imported = 0
+    rows = []
+    # The previous state of the record being imported, with its full data
+    previous_record_state: RecordState | None = None
+    imported_record_keys: set[str] = set()
+
+    for line_number, line in enumerate(file, start=2):
+        if not line.strip():
+            continue
+
+        record_state = RecordState.model_validate(
+            orjson.loads(line), update={"logbook_id": logbook.id}
+        )
+
+        if (
+            previous_record_state is not None
+            and previous_record_state.key != record_state.key
+        ):
+            imported_record_keys.add(previous_record_state.key)
+            previous_record_state = None
+
+        if record_state.key in imported_record_keys or (
+            previous_record_state is not None
+            and (record_state.created_at, record_state.id)
+            <= (previous_record_state.created_at, previous_record_state.id)
+        ):
+            raise ValueError(
+                f"Line {line_number}: the states of a record have to follow each "
+                "other, in the order they were created"
+            )
+
+        data = record_state.data
+
+        crud.store_record_state_data(
+            record_state,
+            data,
+            logbook.keyframe_interval,
+            previous_record_state.data if previous_record_state else None,
+            previous_record_state.keyframe_distance if previous_record_state else 0,
+        )
+        rows.append(crud.record_state_row(record_state))
+
+        # The next state of the record is stored relative to the full data
+        record_state.data = data
+        previous_record_state = record_state
+
+        if len(rows) >= settings.DATABASE_IMPORT_BATCH_SIZE:
+            imported += insert_imported_record_states(db, rows, resume)
+            rows = []
+
+            if progress is not None:
+                progress(imported)
+
+    imported += insert_imported_record_states(db, rows, resume)
+
+    return imported
+
+
+def insert_imported_record_states(db: Session, rows: list[dict], resume: bool):
+    if resume and rows:
+        existing_ids = crud.find_existing_record_state_ids(
+            db, [row["id"] for row in rows]
+        )
+        rows = [row for row in rows if row["id"] not in existing_ids]
+
+    crud.insert_record_states(db, rows)
+    crud.update_record_heads(db, rows)
+    db.commit()
+
+    return len(rows)
@@ -1,11 +1,22 @@
+import base64
+import difflib
+import hashlib
 import json
 import re
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from datetime import datetime
 from enum import Enum
 from typing import Any
+from uuid import UUID
 
-from deepdiff import DeepDiff, DeepHash
+from itertools import zip_longest
 
-from app.api.routes.schemas import RecordStateDiff
+import orjson
+from deepdiff import DeepDiff
+
+from app.api.routes.schemas import DiffDict, RecordStateDiff
+from app.core.metrics import diff_duration, hash_duration
 from app.models import RecordStateBase
 
 
@@ -14,95 +25,515 @@ class DiffNotation(str, Enum):
     dot = "dot"
 
 
-def generate_diff_any(base: Any, other: Any):
-    return DeepDiff(base, other)
+DIFF_PATH_REPORT_TYPES = (
+    "values_changed",
+    "type_changes",
+    "iterable_item_added",
+    "iterable_item_removed",
+    "iterable_item_moved",
+    "dictionary_item_added",
+    "dictionary_item_removed",
+)
+
+# Same defaults DeepDiff uses, the diffs stay identical to what it reports
+DIFF_THRESHOLD_TO_DIFF_DEEPER = 0.33
+DIFF_BASIC_TYPES = (str, int, float, bool, type(None))
+
+
+def generate_diff_any(
+    base: Any, other: Any, notation: DiffNotation = DiffNotation.python
+) -> dict:
+    """
+    Diffs two plain JSON documents.
+
+    Specialised replacement for DeepDiff, which is built for arbitrary python
+    objects. Reports the same changes as DeepDiff with its default options,
+    but builds the paths in the requested notation right away.
+    """
+    diff = defaultdict(list)
+    root = "root"
+
+    with diff_duration.time():
+        _diff_json(base, other, root, notation, diff)
+        _mutual_add_removes_to_values_changed(diff)
+
+    if notation == DiffNotation.dot:
+        return {
+            report_type: [_finish_dot_path(path) for path in paths]
+            for report_type, paths in diff.items()
+            if paths
+        }
+
+    return {report_type: paths for report_type, paths in diff.items() if paths}
+
+
+def _diff_json(t1: Any, t2: Any, path: str, notation: DiffNotation, diff: dict):
+    if t1 is t2:
+        return
+
+    if type(t1) is not type(t2):
+        diff["type_changes"].append(path)
+    elif isinstance(t1, dict):
+        _diff_dict(t1, t2, path, notation, diff)
+    elif isinstance(t1, list):
+        _diff_list(t1, t2, path, notation, diff)
+    elif t1 != t2:
+        diff["values_changed"].append(path)
+
+
+def _diff_dict(t1: dict, t2: dict, path: str, notation: DiffNotation, diff: dict):
+    keys_intersect = [key for key in t2 if key in t1]
+    keys_union_len = len(t1) + len(t2) - len(keys_intersect)
+
+    # Report mostly replaced dicts as a whole instead of every single key
+    if (
+        keys_union_len > 1
+        and len(keys_intersect) / keys_union_len < DIFF_THRESHOLD_TO_DIFF_DEEPER
+    ):
+        diff["values_changed"].append(path)
+        return
+
+    for key in t2:
+        if key not in t1:
+            diff["dictionary_item_added"].append(_key_path(path, key, notation))
+
+    for key in t1:
+        if key not in t2:
+            diff["dictionary_item_removed"].append(_key_path(path, key, notation))
+
+    for key in keys_intersect:
+        _diff_json(t1[key], t2[key], _key_path(path, key, notation), notation, diff)
+
+
+def _diff_list(t1: list, t2: list, path: str, notation: DiffNotation, diff: dict):
+    if not all(isinstance(item, DIFF_BASIC_TYPES) for item in t1) or not all(
+        isinstance(item, DIFF_BASIC_TYPES) for item in t2
+    ):
+        _diff_list_pairwise(t1, t2, 0, 0, path, notation, diff)
+        return
+
+    # Lists of plain values are aligned with difflib, so an insert doesn't show
+    # up as a change of every item after it
+    opcodes_diff = defaultdict(list)
+
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+        None, t1, t2, autojunk=False
+    ).get_opcodes():
+        if tag == "replace":
+            _diff_list_pairwise(
+                t1[i1:i2], t2[j1:j2], i1, j1, path, notation, opcodes_diff
+            )
+        elif tag == "delete":
+            opcodes_diff["iterable_item_removed"].extend(
+                _index_path(path, i) for i in range(i1, i2)
+            )
+        elif tag == "insert":
+            opcodes_diff["iterable_item_added"].extend(
+                _index_path(path, j) for j in range(j1, j2)
+            )
+
+    opcodes_diff_len = sum(len(paths) for paths in opcodes_diff.values())
+
+    # Sometimes comparing item by item reports fewer changes
+    if opcodes_diff_len > 1:
+        pairwise_diff = defaultdict(list)
+        _diff_list_pairwise(t1, t2, 0, 0, path, notation, pairwise_diff)
+
+        if opcodes_diff_len >= sum(len(paths) for paths in pairwise_diff.values()):
+            opcodes_diff = pairwise_diff
+
+    for report_type, paths in opcodes_diff.items():
+        diff[report_type].extend(paths)
+
+
+def _diff_list_pairwise(
+    t1: list,
+    t2: list,
+    t1_offset: int,
+    t2_offset: int,
+    path: str,
+    notation: DiffNotation,
+    diff: dict,
+):
+    missing = object()
+
+    for index, (x, y) in enumerate(zip_longest(t1, t2, fillvalue=missing)):
+        i = index + t1_offset
+        j = index + t2_offset
+
+        if y is missing:
+            diff["iterable_item_removed"].append(_index_path(path, i))
+        elif x is missing:
+            diff["iterable_item_added"].append(_index_path(path, j))
+        elif i != j and x == y:
+            diff["iterable_item_moved"].append(_index_path(path, i))
+        else:
+            _diff_json(x, y, _index_path(path, i), notation, diff)
+
+
+def _mutual_add_removes_to_values_changed(diff: dict):
+    mutual_paths = set(diff.get("iterable_item_added", ())) & set(
+        diff.get("iterable_item_removed", ())
+    )
+
+    if not mutual_paths:
+        return
+
+    for report_type in ("iterable_item_added", "iterable_item_removed"):
+        diff[report_type] = [
+            path for path in diff[report_type] if path not in mutual_paths
+        ]
+
+    diff["values_changed"].extend(mutual_paths)
+
+
+def _key_path(path: str, key: Any, notation: DiffNotation):
+    if not isinstance(key, str):
+        return f"{path}[{key}]"
+
+    if "'" in key:
+        return f'{path}["{key}"]'
+
+    if notation == DiffNotation.dot and key:
+        return f"{path}.{key}"
+
+    return f"{path}['{key}']"
+
+
+def _index_path(path: str, index: int):
+    return f"{path}[{index}]"
+
+
+def _finish_dot_path(path: str):
+    # Same result as convert_diff_path_to_dot_notation
+    return path[5:] if path.startswith("root.") else path
 
 
 def generate_diff(
-    base_record_state: RecordStateDiff,
-    other_record_state: RecordStateDiff,
+    base_record_state: RecordStateBase,
+    other_record_state: RecordStateBase,
     notation: DiffNotation = DiffNotation.python,
 ):
-    return deep_diff_to_dict(
-        generate_diff_any(base_record_state.data, other_record_state.data), notation
+    return generate_diff_any(base_record_state.data, other_record_state.data, notation)
+
+
+def generate_diff_to_previous(
+    previous_record_state: RecordStateBase | None, record_state: RecordStateBase
+) -> dict | None:
+    if previous_record_state is None:
+        return None
+
+    # Stored in python notation, reads convert it to the requested one
+    return generate_diff(previous_record_state, record_state) or None
+
+
+def generate_hash(data: Any) -> str:
+    with hash_duration.time():
+        # Canonical JSON, so the hash doesn't depend on the order of the keys
+        canonical = json.dumps(
+            data, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def generate_etag(*parts: Any) -> str:
+    return f'"{generate_hash([str(part) for part in parts])[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+
+    return any(
+        candidate.strip().removeprefix("W/") in ("*", etag)
+        for candidate in if_none_match.split(",")
     )
 
 
+def generate_patch(base: Any, other: Any, path: str = "") -> list[dict]:
+    """JSON patch (RFC 6902) that turns base into other."""
+    if type(base) is not type(other):
+        return [{"op": "replace", "path": path, "value": other}]
+
+    if isinstance(base, dict):
+        patch = [
+            {"op": "remove", "path": _patch_path(path, key)}
+            for key in base
+            if key not in other
+        ]
+
+        for key, value in other.items():
+            if key in base:
+                patch.extend(generate_patch(base[key], value, _patch_path(path, key)))
+            else:
+                patch.append({"op": "add", "path": _patch_path(path, key), "value": value})
+
+        return patch
+
+    if isinstance(base, list):
+        patch = []
+
+        for index in range(min(len(base), len(other))):
+            patch.extend(
+                generate_patch(base[index], other[index], _patch_path(path, index))
+            )
+
+        # Remove from the back, so the indexes stay valid
+        for index in reversed(range(len(other), len(base))):
+            patch.append({"op": "remove", "path": _patch_path(path, index)})
+
+        for index in range(len(base), len(other)):
+            patch.append(
+                {"op": "add", "path": _patch_path(path, index), "value": other[index]}
+            )
+
+        return patch
+
+    if base != other:
+        return [{"op": "replace", "path": path, "value": other}]
+
+    return []
+
+
+def apply_patch(document: Any, patch: list[dict]) -> Any:
+    """
+    Applies a JSON patch created by generate_patch.
+
+    Containers along the patched paths are copied, the rest is shared with
+    the given document, which stays unchanged.
+    """
+    for operation in patch:
+        tokens = [
+            token.replace("~1", "/").replace("~0", "~")
+            for token in operation["path"].split("/")[1:]
+        ]
+        document = _apply_operation(document, tokens, operation)
+
+    return document
+
+
+def _apply_operation(document: Any, tokens: list[str], operation: dict) -> Any:
+    if not tokens:
+        return operation["value"]
+
+    document = document.copy()
+    key = int(tokens[0]) if isinstance(document, list) else tokens[0]
+
+    if len(tokens) > 1:
+        document[key] = _apply_operation(document[key], tokens[1:], operation)
+    elif operation["op"] == "remove":
+        del document[key]
+    elif operation["op"] == "add" and isinstance(document, list):
+        document.insert(key, operation["value"])
+    else:
+        document[key] = operation["value"]
+
+    return document
+
+
+def _patch_path(path: str, key: str | int):
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
 def generate_diffs(
     record_states: list[RecordStateBase], notation: DiffNotation = DiffNotation.python
 ) -> list[RecordStateDiff]:
-    diff_pairs = [
-        (
-            record_states[i],
-            (
-                {}
-                if i == 0
-                else generate_diff(record_states[i - 1], record_states[i], notation)
+    return list(iter_diffs(record_states, notation))
+
+
+def iter_diffs(
+    record_states: Iterable[RecordStateBase],
+    notation: DiffNotation = DiffNotation.python,
+) -> Iterator[RecordStateDiff]:
+    # Diffs and hashes are stored with the states, so this works on streamed results
+    for record_state in record_states:
+        yield RecordStateDiff(
+            id=record_state.id,
+            key=record_state.key,
+            data=record_state.data,
+            meta=record_state.meta,
+            created_at=record_state.created_at,
+            diff_to_previous=(
+                convert_diff_notation(record_state.diff_to_previous, notation)
+                if record_state.diff_to_previous
+                else None
             ),
+            hash=record_state.hash,
         )
-        for i in range(0, len(record_states))
-    ]
-
-    return [
-        RecordStateDiff(
-            id=pair[0].id,
-            key=pair[0].key,
-            data=pair[0].data,
-            meta=pair[0].meta,
-            created_at=pair[0].created_at,
-            diff_to_previous=pair[1] if pair[1] != {} else None,
-            hash=DeepHash(pair[0].data)[pair[0].data],
-        )
-        for pair in diff_pairs
-    ]
+
+
+def record_state_content(record_state: RecordStateBase, raw_data: str | None = None):
+    """Response content of a state, shaped like the RecordState model.
+
+    Data read as JSON text is embedded as it is, without parsing it and
+    serializing it again.
+    """
+    content = record_state.model_dump(exclude={"data"})
+    content["data"] = record_state_data_content(record_state, raw_data)
+
+    return content
+
+
+def iter_diff_contents(
+    record_states: Iterable[tuple[RecordStateBase, str | None]],
+    notation: DiffNotation = DiffNotation.python,
+) -> Iterator[dict]:
+    """Like iter_diffs, but builds the response content shaped like RecordStateDiff
+    directly, for states with their data as JSON text."""
+    for record_state, raw_data in record_states:
+        yield {
+            "id": record_state.id,
+            "key": record_state.key,
+            "data": record_state_data_content(record_state, raw_data),
+            "meta": record_state.meta,
+            "created_at": record_state.created_at,
+            "diff_to_previous": (
+                diff_dict_content(
+                    convert_diff_notation(record_state.diff_to_previous, notation)
+                )
+                if record_state.diff_to_previous
+                else None
+            ),
+            "hash": record_state.hash,
+        }
+
+
+def record_state_data_content(record_state: RecordStateBase, raw_data: str | None):
+    return orjson.Fragment(raw_data) if raw_data is not None else record_state.data
+
+
+def diff_dict_content(diff: dict):
+    return {
+        report_type: diff.get(report_type, []) for report_type in DiffDict.model_fields
+    }
+
+
+# One key or index of a diff path, in python or dot notation
+DIFF_PATH_TOKEN = re.compile(
+    r"""\[(\d+)\]|\['([^']*)'\]|\["([^"]*)"\]|\.?([^.\[\]'"]+)"""
+)
+# Changes that shift the items after them in a list
+DIFF_LIST_SHIFT_REPORT_TYPES = (
+    "iterable_item_added",
+    "iterable_item_removed",
+    "iterable_item_moved",
+)
+
+
+def parse_diff_path(path: str) -> list[str | int]:
+    """Splits a diff path like root['a'][0] or a[0].b into its keys and indexes."""
+    if path == "root" or path.startswith(("root[", "root.")):
+        path = path[4:]
+
+    tokens = []
+    position = 0
+
+    while position < len(path):
+        match = DIFF_PATH_TOKEN.match(path, position)
+
+        # Only the first key may go without a dot in front of it
+        if match is None or (
+            match[4] is not None and position and path[position] != "."
+        ):
+            raise ValueError(f"Invalid path: {path}")
+
+        index, *keys = match.groups()
+
+        if index is not None:
+            tokens.append(int(index))
+        else:
+            tokens.append(next(key for key in keys if key is not None))
+
+        position = match.end()
+
+    return tokens
+
+
+def get_path_value(data: Any, path: list[str | int]) -> tuple[bool, Any]:
+    """Looks a parsed path up in a document, returns if it exists and its value."""
+    for token in path:
+        if isinstance(token, int) and isinstance(data, list) and token < len(data):
+            data = data[token]
+        elif isinstance(token, str) and isinstance(data, dict) and token in data:
+            data = data[token]
+        else:
+            return False, None
+
+    return True, data
+
+
+def diff_touches_path(diff: dict, path: list[str | int]) -> bool:
+    """If the value at a parsed path may have changed with a stored diff.
+
+    Changes above or below the path count, as well as added, removed and moved
+    items of a list above it, which shift the index of the path.
+    """
+    for report_type in DIFF_PATH_REPORT_TYPES:
+        for changed_path in map(parse_diff_path, diff.get(report_type, ())):
+            common = min(len(changed_path), len(path))
+
+            if changed_path[:common] == path[:common]:
+                return True
+
+            if (
+                report_type in DIFF_LIST_SHIFT_REPORT_TYPES
+                and len(changed_path) <= len(path)
+                and changed_path[:-1] == path[: len(changed_path) - 1]
+            ):
+                return True
+
+    return False
+
+
+def encode_cursor(record_state: RecordStateBase) -> str:
+    value = f"{record_state.created_at.isoformat()}|{record_state.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(created_at), UUID(id)
+
+
+def encode_record_cursor(record_key: str) -> str:
+    return base64.urlsafe_b64encode(record_key.encode()).decode()
+
+
+def decode_record_cursor(cursor: str) -> str:
+    return base64.urlsafe_b64decode(cursor.encode()).decode()
+
+
+def to_local_time(value: datetime) -> datetime:
+    # States are stored with the local time of the server, without a time zone
+    if value.tzinfo is None:
+        return value
+
+    return value.astimezone().replace(tzinfo=None)
 
 
 def deep_diff_to_dict(diff: DeepDiff, notation: DiffNotation = DiffNotation.python):
     # diff.to_dict() has some weird types
     diff_dict = json.loads(diff.to_json())
 
-    if "values_changed" in diff_dict:
-        diff_dict["values_changed"] = list(diff_dict["values_changed"].keys())
+    # Depending on the report type the paths are keys of a dict or already a list
+    for report_type in DIFF_PATH_REPORT_TYPES:
+        if report_type in diff_dict:
+            diff_dict[report_type] = list(diff_dict[report_type])
 
-    if "iterable_item_added" in diff_dict:
-        diff_dict["iterable_item_added"] = list(diff_dict["iterable_item_added"].keys())
+    return convert_diff_notation(diff_dict, notation)
 
-    if "iterable_item_removed" in diff_dict:
-        diff_dict["iterable_item_removed"] = list(
-            diff_dict["iterable_item_removed"].keys()
-        )
 
-    if "dictionary_item_added" in diff_dict:
-        diff_dict["dictionary_item_added"] = list(
-            diff_dict["dictionary_item_added"].keys()
-        )
+def convert_diff_notation(diff_dict: dict, notation: DiffNotation):
+    if notation == DiffNotation.python:
+        return diff_dict
 
-    if "dictionary_item_removed" in diff_dict:
-        diff_dict["dictionary_item_removed"] = list(
-            diff_dict["dictionary_item_removed"].keys()
+    return {
+        report_type: (
+            convert_list_keys(paths) if report_type in DIFF_PATH_REPORT_TYPES else paths
         )
-
-    if notation == DiffNotation.dot:
-        if "values_changed" in diff_dict:
-            diff_dict["values_changed"] = convert_list_keys(diff_dict["values_changed"])
-        if "iterable_item_added" in diff_dict:
-            diff_dict["iterable_item_added"] = convert_list_keys(
-                diff_dict["iterable_item_added"]
-            )
-        if "iterable_item_removed" in diff_dict:
-            diff_dict["iterable_item_removed"] = convert_list_keys(
-                diff_dict["iterable_item_removed"]
-            )
-        if "dictionary_item_added" in diff_dict:
-            diff_dict["dictionary_item_added"] = convert_list_keys(
-                diff_dict["dictionary_item_added"]
-            )
-        if "dictionary_item_removed" in diff_dict:
-            diff_dict["dictionary_item_removed"] = convert_list_keys(
-                diff_dict["dictionary_item_removed"]
-            )
-
-    return diff_dict
+        for report_type, paths in diff_dict.items()
+    }
 
 
 def convert_diff_path_to_dot_notation(path):
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Settings are read on import, the tests run on a SQLite file of their own
+# unless a Postgres server is set
+if not os.environ.get("POSTGRES_SERVER"):
+    os.environ.setdefault(
+        "SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "test.sqlite3")
+    )
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlmodel import Session  # noqa: E402
+
+from app import crud  # noqa: E402
+from app.core.db import engine, transaction_engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import LogbookBase  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    # Starting the app migrates the database
+    with TestClient(app, headers={"Accept-Encoding": "identity"}) as client:
+        yield client
+
+
+@pytest.fixture
+def db(client):
+    with Session(transaction_engine, expire_on_commit=False) as db:
+        yield db
+
+
+@pytest.fixture
+def create_logbook(client):
+    keys = []
+
+    def create_logbook(**fields):
+        key = f"test-{uuid.uuid4().hex[:8]}"
+
+        with Session(transaction_engine, expire_on_commit=False) as db:
+            crud.create_logbook(db, LogbookBase(key=key, **fields))
+
+        keys.append(key)
+
+        return key
+
+    yield create_logbook
+
+    with Session(engine) as db:
+        for key in keys:
+            crud.delete_logbook(db, key)
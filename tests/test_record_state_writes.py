@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from app import crud
+from app.utils import generate_diff_to_previous
+
+CONCURRENT_WRITES = 20
+
+
+def post_concurrently(client, url: str, bodies: list[dict]):
+    with ThreadPoolExecutor(max_workers=len(bodies)) as executor:
+        return list(executor.map(lambda body: client.post(url, json=body), bodies))
+
+
+def test_concurrent_writes_diff_against_the_stored_previous_state(
+    client, db, create_logbook
+):
+    logbook_key = create_logbook()
+
+    responses = post_concurrently(
+        client,
+        f"/v1/logbook/{logbook_key}/record/record/state",
+        [{"data": {"value": index}} for index in range(CONCURRENT_WRITES)],
+    )
+
+    assert all(response.status_code == 200 for response in responses)
+
+    record_states = crud.find_record_states(db, logbook_key, "record")
+
+    assert len(record_states) == CONCURRENT_WRITES
+
+    for previous_record_state, record_state in zip(
+        [None, *record_states], record_states
+    ):
+        assert record_state.diff_to_previous == generate_diff_to_previous(
+            previous_record_state, record_state
+        )
+
+
+def test_concurrent_unchanged_writes_store_one_state(client, db, create_logbook):
+    logbook_key = create_logbook()
+
+    responses = post_concurrently(
+        client,
+        f"/v1/logbook/{logbook_key}/record/record/state?prevent_no_changes=true",
+        [{"data": {"value": 1}}] * CONCURRENT_WRITES,
+    )
+
+    assert sorted(response.status_code for response in responses) == [200] + [406] * (
+        CONCURRENT_WRITES - 1
+    )
+    assert len(crud.find_record_states(db, logbook_key, "record")) == 1
+
+
+def test_concurrent_bulk_writes_diff_against_the_stored_previous_state(
+    client, db, create_logbook
+):
+    logbook_key = create_logbook()
+
+    responses = post_concurrently(
+        client,
+        f"/v1/logbook/{logbook_key}/states",
+        [
+            [
+                {"record_key": record_key, "data": {"value": index}}
+                for record_key in ("a", "b", "c")[:: 1 if index % 2 else -1]
+            ]
+            for index in range(CONCURRENT_WRITES)
+        ],
+    )
+
+    assert all(response.status_code == 200 for response in responses)
+
+    for record_key in ("a", "b", "c"):
+        record_states = crud.find_record_states(db, logbook_key, record_key)
+
+        assert len(record_states) == CONCURRENT_WRITES
+
+        for previous_record_state, record_state in zip(
+            [None, *record_states], record_states
+        ):
+            assert record_state.diff_to_previous == generate_diff_to_previous(
+                previous_record_state, record_state
+            )